@@ -0,0 +1,245 @@
+
+# A plan's key lack is scored by TK + 2*MK, where
+#     TK is the total number of missing keys
+#     MK is the maximum number of missing keys for any single portal
+
+import copy
+import numpy as np
+
+class KeyLackTally:
+    '''
+    The key lack of every portal, kept up to date one incoming link at a time
+        lack[p] is the number of incoming links of p minus its keys (negative if there's a surplus)
+        TK and MK are as above
+        count[l] is the number of portals missing l > 0 keys, so MK is found without a search
+            (count[0] is not kept)
+    '''
+    def __init__(self,keys):
+        self.lack  = -keys
+        self.count = np.zeros(len(keys)+1,dtype=int)
+        self.TK = 0
+        self.MK = 0
+
+    def add(self,q):
+        # q got another incoming link
+        self.lack[q] += 1
+        l = self.lack[q]
+        if l > 0:
+            self.TK += 1
+            self.count[l]   += 1
+            self.count[l-1] -= 1
+            if l > self.MK:
+                self.MK = l
+
+    def remove(self,q):
+        # q lost an incoming link
+        l = self.lack[q]
+        self.lack[q] -= 1
+        if l > 0:
+            self.TK -= 1
+            self.count[l]   -= 1
+            self.count[l-1] += 1
+            while self.MK > 0 and self.count[self.MK] == 0:
+                self.MK -= 1
+
+    def removeMany(self,qs):
+        # Each q in qs lost an incoming link (qs may repeat)
+        qs,times = np.unique(qs,return_counts=True)
+        oldlack = self.lack[qs]
+        self.lack[qs] -= times
+        old = np.maximum(oldlack,0)
+        new = np.maximum(self.lack[qs],0)
+
+        np.subtract.at(self.count,old,1)
+        np.add.at(self.count,new,1)
+        self.TK -= (old-new).sum()
+        while self.MK > 0 and self.count[self.MK] == 0:
+            self.MK -= 1
+
+class PlanGraph:
+    '''
+    A compact, array-backed stand-in for the networkx.DiGraph that is built while making a plan
+
+    Portal data (xy, xyz, keys, sides) is shared by every copy; only the links belong to one plan
+        link[p,q] = i+1 if the ith link to be made is p->q
+        link[q,p] = -(i+1) for the same link
+        link[p,q] = 0 if there is no link between p and q
+        edges[i] is (p,q) for the ith link
+        reversible[i] is True if the ith link may be flipped
+        outdeg[p], indeg[p] are the out- and in-degrees of p
+        lacks is the KeyLackTally of all links
+
+    Links are only ever added to the end, so undo(mark) removes every link made since mark
+    '''
+    def __init__(self,a,sides=None):
+        '''
+        a is a networkx.DiGraph with 'xy', 'xyz' and 'keys' for each portal
+        sides is the containment index from geometry.sideSets
+            Triangles find their contents with it when it is given
+        '''
+        self.n = a.order()
+        self.xy   = np.array([a.node[i]['xy' ] for i in xrange(self.n)])
+        self.xyz  = np.array([a.node[i]['xyz'] for i in xrange(self.n)])
+        self.keys = np.array([a.node[i]['keys'] for i in xrange(self.n)],dtype=int)
+        self.sides = sides
+
+        self.clear()
+
+    def clear(self):
+        # Remove all links
+        n = self.n
+        self.link    = np.zeros([n,n],dtype=np.int32)
+        self.outdeg  = np.zeros(n,dtype=int)
+        self.indeg   = np.zeros(n,dtype=int)
+        self.lacks   = KeyLackTally(self.keys)
+
+        # A triangulation of n portals has fewer than 3n links
+        self.edges      = np.empty([3*n,2],dtype=int)
+        self.reversible = np.empty(3*n,dtype=bool)
+        self.m = 0
+
+        self.triangulation = []
+        # The number of failed Triangle builds
+        self.deadends = 0
+
+    def copy(self):
+        # A graph with the same portals and no links
+        b = copy.copy(self)
+        b.clear()
+        return b
+
+    def order(self):
+        return self.n
+
+    def size(self):
+        return self.m
+
+    def has_edge(self,p,q):
+        return self.link[p,q] > 0
+
+    def hasLink(self,p,q):
+        # True iff there is a link between p and q in either direction
+        return self.link[p,q] != 0
+
+    def out_degree(self,p):
+        return self.outdeg[p]
+
+    def in_degree(self,p):
+        return self.indeg[p]
+
+    def addEdge(self,p,q,reversible):
+        i = self.m
+        self.edges[i] = p,q
+        self.reversible[i] = reversible
+        self.link[p,q] =  i+1
+        self.link[q,p] = -i-1
+        self.outdeg[p] += 1
+        self.indeg [q] += 1
+        self.lacks.add(q)
+        self.m = i+1
+
+    def flip(self,p,q):
+        # Reverse the link p->q in place. It keeps its position in the order
+        i = self.link[p,q]-1
+        self.edges[i] = q,p
+        self.link[q,p] =  i+1
+        self.link[p,q] = -i-1
+        self.outdeg[p] -= 1
+        self.indeg [p] += 1
+        self.outdeg[q] += 1
+        self.indeg [q] -= 1
+        self.lacks.add(p)
+        self.lacks.remove(q)
+
+    def freeOutgoing(self,p):
+        '''
+        Tries to give p room for another outgoing link
+        by reversing one of its reversible outgoing links
+        The other end must be left with room of its own
+
+        returns True if a link was reversed
+        '''
+        heads = (self.link[p] > 0).nonzero()[0]
+        heads = heads[ self.reversible[self.link[p,heads]-1] ]
+        heads = heads[ self.outdeg[heads] < 7 ]
+        if len(heads) == 0:
+            return False
+        self.flip(p,heads[np.argmin(self.outdeg[heads])])
+        return True
+
+    def leftOf(self,p,q):
+        '''
+        A mask of the portals strictly on the left of the great circle through p,q
+            with the same test that Triangles find their contents with
+        '''
+        if self.sides is not None:
+            bits = self.sides[p][q]
+            return np.array([ bits >> x & 1 for x in xrange(self.n) ],dtype=bool)
+        return np.dot(np.cross(self.xyz[p],self.xyz[q]),self.xyz.T) > 0
+
+    def inLine(self,p,q,r):
+        # True iff r is on the great circle through p,q, so p,q,r make no field
+        if self.sides is not None:
+            return not (self.sides[p][q] >> r & 1 or self.sides[q][p] >> r & 1)
+        return np.dot(np.cross(self.xyz[p],self.xyz[q]),self.xyz[r]) == 0
+
+    def undo(self,mark):
+        # Remove every link made since there were mark links
+        if mark >= self.m:
+            return
+        gone = self.edges[mark:self.m]
+        self.link[gone[:,0],gone[:,1]] = 0
+        self.link[gone[:,1],gone[:,0]] = 0
+        np.subtract.at(self.outdeg,gone[:,0],1)
+        np.subtract.at(self.indeg ,gone[:,1],1)
+        self.lacks.removeMany(gone[:,1])
+        self.m = mark
+
+    def snapshot(self):
+        # A copy of the links to restore later
+        return (self.link.copy(),self.outdeg.copy(),self.indeg.copy(),\
+                self.edges.copy(),self.reversible.copy(),self.m,\
+                copy.deepcopy(self.lacks))
+
+    def restore(self,state):
+        # Put the links back the way they were at snapshot
+        link,outdeg,indeg,edges,reversible,m,lacks = state
+        self.link[:]       = link
+        self.outdeg[:]     = outdeg
+        self.indeg[:]      = indeg
+        self.edges[:]      = edges
+        self.reversible[:] = reversible
+        self.m = m
+        self.lacks = copy.deepcopy(lacks)
+
+    def keyLack(self):
+        '''
+        Returns TK,MK (see the top of this file)
+        '''
+        return self.lacks.TK,self.lacks.MK
+
+    def toDiGraph(self,a):
+        '''
+        a is the networkx.DiGraph this PlanGraph was made from
+
+        returns a copy of a with the links of this plan
+            edges have the properties 'order', 'reversible' and 'fields'
+            the triangulation is moved onto the new graph
+        '''
+        b = a.copy()
+        edges      = self.edges[:self.m].tolist()
+        reversible = self.reversible[:self.m].tolist()
+        for i in xrange(self.m):
+            p,q = edges[i]
+            b.add_edge(p,q,{'order':i,'reversible':reversible[i],'fields':[]})
+
+        b.triangulation = self.triangulation
+
+        # The triangles should refer to the graph that will be kept
+        stack = list(b.triangulation)
+        while len(stack) > 0:
+            t = stack.pop()
+            t.a = b
+            stack.extend(t.children)
+
+        return b
@@ -18,7 +18,7 @@ def commaGroup(n):
     return ','.join([ s[max(i,0):i+3] for i in range(len(s)-3,-3,-3)][::-1])
 
 class PlanPrinter:
-    def __init__(self,a,outputDir,nagents,color='#FF004D'):
+    def __init__(self,a,outputDir,nagents,color='#FF004D',movements=None):
         self.a = a
         self.n = a.order() # number of nodes
         self.m = a.size()  # number of links
@@ -33,7 +33,10 @@ class PlanPrinter:
             self.orderedEdges[a.edge[e[0]][e[1]]['order']] = e
 
         # movements[i][j] is the index (in orderedEdges) of agent i's jth link
-        self.movements = agentOrder.getAgentOrder(a,nagents,self.orderedEdges)
+        # A schedule from agentOrder.sweepAgents can be passed in, with a's time attributes already set
+        if movements is None:
+            movements = agentOrder.getAgentOrder(a,nagents,self.orderedEdges)
+        self.movements = movements
 
         # link2agent[i] is the agent that will make the ith link
         self.link2agent = [-1]*self.m
@@ -258,16 +261,16 @@ class PlanPrinter:
         # Total experience for each agent
         agentexps  = np.zeros(self.nagents,dtype=int)
 
+        dists = agentOrder.portalDists(self.a)
+
         for i in range(self.nagents):
             movie = self.movements[i]
             # first portal in first link
-            curpos = self.a.node[self.orderedEdges[movie[0]][0]]['geo']
+            curpos = self.orderedEdges[movie[0]][0]
             for e in movie[1:]:
                 p,q = self.orderedEdges[e]
-                newpos = self.a.node[p]['geo']
-                dist = geometry.sphereDist(curpos,newpos)
-                agentdists[i] += dist
-                curpos = newpos
+                agentdists[i] += dists[curpos,p]
+                curpos = p
 
                 agentexps[i] += 313 + 1250*len(self.a.edge[p][q]['fields'])
 
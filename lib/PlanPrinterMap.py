@@ -1,16 +1,15 @@
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import geometry
 import numpy as np
 import agentOrder
 import networkx as nx
 import electricSpring
-from cStringIO import StringIO
-from PIL import Image
-import urllib
+import basemap
+import animation
 import math
 import codecs
+import multiprocessing
 
 GREEN = '#3BF256' # Actual faction text colors in the app
 BLUE  = '#2ABBFF'
@@ -31,7 +30,7 @@ def commaGroup(n):
     return ','.join([ s[max(i,0):i+3] for i in range(len(s)-3,-3,-3)][::-1])
 
 class PlanPrinter:
-    def __init__(self, a, outputDir, nagents, color='#FF004D'): # very red purple
+    def __init__(self, a, outputDir, nagents, color='#FF004D', movements=None): # very red purple
         self.a = a
         self.n = a.order() # number of nodes
         self.m = a.size()  # number of links
@@ -57,7 +56,10 @@ class PlanPrinter:
             self.orderedEdges[a.edge[e[0]][e[1]]['order']] = e
 
         # movements[i][j] is the index (in orderedEdges) of agent i's jth link
-        self.movements = agentOrder.getAgentOrder(a, nagents, self.orderedEdges)
+        # A schedule from agentOrder.sweepAgents can be passed in, with a's time attributes already set
+        if movements is None:
+            movements = agentOrder.getAgentOrder(a, nagents, self.orderedEdges)
+        self.movements = movements
         
         # link2agent[i] is the agent that will make the ith link
         self.link2agent = [-1] * self.m
@@ -90,7 +92,8 @@ class PlanPrinter:
 
         self.num_portals = self.n
         self.num_links = self.m
-        self.num_fields = -1
+        # Each field is completed by exactly one link
+        self.num_fields = sum([ len(a.edge[p][q]['fields']) for p,q in self.orderedEdges ])
 
     def keyPrep(self):
         rowFormat = u'{0:11d} | {1:6d} | {2}\n'
@@ -205,7 +208,13 @@ class PlanPrinter:
         nx.draw_networkx_edges(b,self.ptmap,edge_color=self.colorLetter)
         plt.axis('off')
 
-    def planMap(self):
+    def planMap(self,provider=None):
+        '''
+        provider makes the map backgrounds (see basemap.choose), default cached Google maps
+            False leaves out the maps with backgrounds
+        '''
+        if provider is None:
+            provider = basemap.choose()
 
         xmin = self.xy[:,0].min()*1.1
         xmax = self.xy[:,0].max()*1.1
@@ -237,15 +246,18 @@ class PlanPrinter:
         map_ywidth = int(map_ywidth)
         zoom = int(zoom)
 
-        # google maps API
-        url = "http://maps.googleapis.com/maps/api/staticmap?center={0},{1}&size={2}x{3}&zoom={4}&sensor=false".format(self.latcenter,self.loncenter,map_xwidth,map_ywidth,zoom)
-        #print url
-        buffer = StringIO(urllib.urlopen(url).read())
-        image = Image.open(buffer)
+        image = None
+        if provider:
+            try:
+                image = provider.image(self.latcenter,self.loncenter,zoom,map_xwidth,map_ywidth)
+            except basemap.MapUnavailable as e:
+                print 'Making the maps without a background: %s'%e
         plt.clf()
 
         # plot once with map and once without
         for do_map,filename in zip([True,False],["portalMap_google.png","portalMap.png"]):
+            if do_map and image is None:
+                continue
             if do_map:
                 implot = plt.imshow(image,extent=xylims)
             # Plot labels aligned to avoid other portals
@@ -284,6 +296,8 @@ class PlanPrinter:
 
         # draw one with map and one without
         for do_map,filename in zip([True,False],["linkMap_google.png","linkMap.png"]):
+            if do_map and image is None:
+                continue
             # Draw the map with all edges in place and labeled
             if do_map:
                 implot = plt.imshow(image,extent=xylims)
@@ -307,16 +321,16 @@ class PlanPrinter:
         # Total experience for each agent
         agentexps  = np.zeros(self.nagents,dtype=int)
 
+        dists = agentOrder.portalDists(self.a)
+
         for i in range(self.nagents):
             movie = self.movements[i]
             # first portal in first link
-            curpos = self.a.node[self.orderedEdges[movie[0]][0]]['geo']
+            curpos = self.orderedEdges[movie[0]][0]
             for e in movie[1:]:
                 p,q = self.orderedEdges[e]
-                newpos = self.a.node[p]['geo']
-                dist = geometry.sphereDist(curpos,newpos)
-                agentdists[i] += dist
-                curpos = newpos
+                agentdists[i] += dists[curpos,p]
+                curpos = p
 
                 agentexps[i] += 313 + 1250*len(self.a.edge[p][q]['fields'])
 
@@ -380,155 +394,307 @@ class PlanPrinter:
                             self.nslabel[q],\
                             self.names[q]\
                         ))
-    def animate(self):
+    def animate(self,workers=1,animationFormat=None):
         # show or save a sequence of images demonstrating how the plan would unfold
-        from matplotlib.patches import Polygon
-
-        fig = plt.figure()
-        ax  = fig.add_subplot(111)
-
-        GREEN     = ( 0.0 , 1.0 , 0.0 , 0.3)
-        BLUE      = ( 0.0 , 0.0 , 1.0 , 0.3)
-        RED       = ( 1.0 , 0.0 , 0.0 , 0.5)
-        INVISIBLE = ( 0.0 , 0.0 , 0.0 , 0.0 )
-
+        # workers > 1 draws the frames in that many processes
+        # animationFormat 'gif' or 'apng' puts them all in frames.gif or frames.png instead
         portals = np.array([self.a.node[i]['xy'] for i in self.a.nodes_iter()]).T
-        
-        # Plot all edges lightly
-        def dashAllEdges():
-            for p,q in self.a.edges_iter():
-                plt.plot(portals[0,[p,q]],portals[1,[p,q]],'k:')
-
-        aptotal = 0
-
-        edges   = []
-        patches = []
-
-        plt.plot(portals[0],portals[1],self.colorLetter+'o')
-
-        dashAllEdges()
-
-        plt.title('AP:\n%s'%commaGroup(aptotal),ha='center')
-        plt.axis('off')
-        plt.savefig(self.outputDir+'frame_-1.png'.format(i))
-        plt.clf()
-
-        for i in xrange(self.m):
-            p,q = self.orderedEdges[i]
-#            print p,q,self.a.edge[p][q]['fields']
-
-            plt.plot(portals[0],portals[1],self.colorLetter+'o')
-
-            # Plot all edges lightly
-            dashAllEdges()
-
-            for edge in edges:
-                plt.plot(edge[0],edge[1],self.colorLetter+'-')
-
-            # We'll display the new fields in red
-            newPatches = []
-            for tri in self.a.edge[p][q]['fields']:
-#                print 'edge has a field'
-                coords = np.array([ self.a.node[v]['xy'] for v in tri ])
-                newPatches.append(Polygon(shrink(coords.T).T,facecolor=RED,\
-                                                 edgecolor=INVISIBLE))
-#            print '%s new patches'%len(newPatches)
-            
-            aptotal += 313+1250*len(newPatches)
 
-            newEdge = np.array([self.a.node[p]['xy'],self.a.node[q]['xy']]).T
-
-            patches += newPatches
-            edges.append(newEdge)
-
-           # plt.arrow( x, y, dx, dy, **kwargs )
-#            plt.arrow(              newEdge[0,0],\
-#                                    newEdge[1,0],\
-#                       newEdge[0,1]-newEdge[0,0],\
-#                       newEdge[1,1]-newEdge[1,0],\
-#                       fc="k", ec="k")#,head_width=0.0005,head_length=0.001 )
-            
-            plt.plot(newEdge[0],newEdge[1],'k-',lw=2)
-#            plt.plot(newEdge[0],newEdge[1],'g-')
-
-            ax = plt.gca()
-#            print 'adding %s patches'%len(patches)
-            for patch in patches:
-                ax.add_patch(patch)
-
-            ax.set_title('AP:\n%s'%commaGroup(aptotal),ha='center')
-            ax.axis('off')
-            plt.savefig(self.outputDir+'frame_{0:02d}.png'.format(i))
-            ax.cla()
-
-            for patch in newPatches:
-                if self.colorLetter == 'g':
-                    patch.set_facecolor(GREEN)
-                else:
-                    patch.set_facecolor(BLUE)
-
-        plt.plot(portals[0],portals[1],self.colorLetter+'o')
-        for edge in edges:
-            plt.plot(edge[0],edge[1],self.colorLetter+'-')
-        for patch in patches:
-            ax.add_patch(patch)
-
-        ax.set_title('AP:\n%s'%commaGroup(aptotal),ha='center')
-        ax.axis('off')
-        plt.savefig(self.outputDir+'frame_%s.png'%self.m)
-        ax.cla()
-
-        self.num_fields = len(patches)
-
-    def split3instruct(self):
+        # lines[i] has the x-coordinates and y-coordinates of link i
+        # fields[i] has the (shrunken) corners of the fields link i completes
+        lines  = []
+        fields = []
+        for p,q in self.orderedEdges:
+            lines.append(np.array([self.a.node[p]['xy'],self.a.node[q]['xy']]).T)
+            fields.append([ shrink(np.array([ self.a.node[v]['xy'] for v in tri ]).T).T\
+                            for tri in self.a.edge[p][q]['fields'] ])
+
+        # Every link, to be plotted lightly
+        dashed = [ portals[:,[p,q]] for p,q in self.a.edges_iter() ]
+
+        # aptotal[i] is the AP earned once link i is made
+        aptotal = np.cumsum([ 313+1250*len(tris) for tris in fields ]).tolist()
+
+        frameData = {
+            'portals'     : portals,
+            'lines'       : lines,
+            'dashed'      : dashed,
+            'fields'      : fields,
+            'aptotal'     : aptotal,
+            'colorLetter' : self.colorLetter,
+            'outputDir'   : self.outputDir,
+            'name'        : 'frame',
+            'last'        : self.m,
+            'animation'   : animationFormat,
+        }
+        drawAnimation(animateFrames,frameData,range(-1,self.m+1),workers,self.outputDir+'frames')
+
+    def split3instruct(self,workers=1,animationFormat=None):
+        # workers > 1 draws the images in that many processes
+        # animationFormat 'gif' or 'apng' puts them all in depths.gif or depths.png instead
         portals = np.array([self.a.node[i]['xy'] for i in self.a.nodes_iter()]).T
         
         gen1 = self.a.triangulation
 
-        oldedges = []
-
-        plt.plot(portals[0],portals[1],self.colorLetter+'o')
-
-        plt.axis('off')
-        plt.savefig(self.outputDir+'depth_-1.png')
-        plt.clf()
-
-        depth = 0
+        # depthEdges[depth][i][0] has the x-coordinates of both verts of edge i
+        depthEdges = []
         while True:
-            # newedges[i][0] has the x-coordinates of both verts of edge i
             newedges = [ np.array([
                                 self.a.node[p]['xy'] ,\
                                 self.a.node[q]['xy']
                          ]).T\
                              for j in range(len(gen1)) \
-                             for p,q in gen1[j].edgesByDepth(depth)\
+                             for p,q in gen1[j].edgesByDepth(len(depthEdges))\
                        ]
 
             if len(newedges) == 0:
                 break
-            
-#            plt.plot(portals[0],portals[1],'go')
-            plt.plot(portals[0],portals[1],'bo')
-
-            for edge in oldedges:
-                plt.plot(edge[0],edge[1],'k-')
+            depthEdges.append(newedges)
+
+        depthData = {
+            'portals'     : portals,
+            'depthEdges'  : depthEdges,
+            'colorLetter' : self.colorLetter,
+            'outputDir'   : self.outputDir,
+            'name'        : 'depth',
+            'last'        : len(depthEdges),
+            'animation'   : animationFormat,
+        }
+        drawAnimation(drawDepths,depthData,range(-1,len(depthEdges)+1),workers,self.outputDir+'depths')
+
+class FrameWriter:
+    '''
+    Saves the images of animateFrames and drawDepths
+        data['name'] is the start of the file names and data['animation'] the format
+    Without a format each image is a PNG file <name>_<i>.png
+    With one they are encoded for a single file
+        and passed to out(size,data) as they are made (as animation.Writer.add takes them)
+        or without out kept for result() to return in one piece
+
+    The first image is -1 and the last is data['last']
+    A run of images that starts later needs the one before it drawn and shown to skip()
+    '''
+    def __init__(self,data,fig,out=None):
+        self.data = data
+        self.fig  = fig
+        self.out  = out
+        self.encoded = []
+        if data['animation'] != None:
+            self.encoder = animation.FrameEncoder(data['animation'])
+
+    def runFrames(self,frames):
+        # The images to draw for the run frames. The first is only for skip() if it isn't in frames
+        if self.data['animation'] != None and frames[0] > -1:
+            return [frames[0]-1]+list(frames)
+        return frames
+
+    def skip(self):
+        self.encoder.skip(animation.figureImage(self.fig))
+
+    def save(self,i):
+        last = self.data['last']
+        if self.data['animation'] != None:
+            if i == last:
+                duration = animation.LAST_FRAME_MS
+            else:
+                duration = animation.FRAME_MS
+            encoded = self.encoder.add(animation.figureImage(self.fig),duration,i+1)
+            if self.out != None:
+                self.out(self.fig.canvas.get_width_height(),encoded)
+            else:
+                self.encoded.append(encoded)
+        elif i == -1 or i == last:
+            self.fig.savefig(self.data['outputDir']+'%s_%s.png'%(self.data['name'],i))
+        else:
+            self.fig.savefig(self.data['outputDir']+'{0}_{1:02d}.png'.format(self.data['name'],i))
+
+    def result(self):
+        # The size of the images and the frames encoded for the file, if they weren't passed to out
+        if self.data['animation'] == None or self.out != None:
+            return None
+        return self.fig.canvas.get_width_height(),''.join(self.encoded)
+
+def animateFrames(data,frames,out=None):
+    '''
+    Saves frames of PlanPrinter.animate, in increasing order, with a FrameWriter(data,fig,out)
+        frame i is the plan just after link i is made, with the fields it completes in red
+        frame -1 is before any links and frame m is the finished plan
+
+    Every artist is made once and updated from frame to frame
+        the light dotted links, the links already made and their fields are each one collection
+        the new link and its fields are appended to those once the next frame comes
+    so a frame takes about the same time to draw however many links came before it
+    Any run of frames can be drawn on its own
+    '''
+    from matplotlib.collections import LineCollection, PolyCollection
+    from matplotlib.path import Path
+
+    GREEN     = ( 0.0 , 1.0 , 0.0 , 0.3)
+    BLUE      = ( 0.0 , 0.0 , 1.0 , 0.3)
+    RED       = ( 1.0 , 0.0 , 0.0 , 0.5)
+    INVISIBLE = ( 0.0 , 0.0 , 0.0 , 0.0 )
+
+    portals     = data['portals']
+    lines       = data['lines']
+    fields      = data['fields']
+    colorLetter = data['colorLetter']
+    m = len(lines)
+
+    if colorLetter == 'g':
+        fieldColor = GREEN
+    else:
+        fieldColor = BLUE
+
+    fig = plt.figure()
+    ax  = fig.add_subplot(111)
+
+    # The fields go under every line and the portals under the links
+    # Collections are drawn before lines of the same zorder, so the portals need a lower one
+    ax.plot(portals[0],portals[1],colorLetter+'o',zorder=1.5)
+
+    # Plot all edges lightly
+    dashes = LineCollection([ edge.T for edge in data['dashed'] ],colors='k',linestyles=':')
+    ax.add_collection(dashes)
+
+    madeLines = LineCollection([],colors=colorLetter,capstyle='projecting')
+    ax.add_collection(madeLines)
+
+    newLine, = ax.plot([],[],'k-',lw=2)
+
+    madeFields = PolyCollection([],facecolors=fieldColor,edgecolors=INVISIBLE)
+    ax.add_collection(madeFields)
+
+    # We'll display the new fields in red
+    newFields = PolyCollection([],facecolors=RED,edgecolors=INVISIBLE)
+    ax.add_collection(newFields)
+
+    ax.axis('off')
+
+    writer = FrameWriter(data,fig,out)
+    runFrames = writer.runFrames(frames)
+
+    # The paths drawn by the collections of the links and fields already made
+    madePaths      = madeLines.get_paths()
+    madeFieldPaths = madeFields.get_paths()
+    shown = 0
+
+    for i in runFrames:
+        # Everything before link i has been made
+        made = max(min(i,m),0)
+        for j in xrange(shown,made):
+            madePaths.append(Path(lines[j].T))
+            for coords in fields[j]:
+                # Closed the way PolyCollection.set_verts closes them
+                coords = np.concatenate([coords,coords[:1]])
+                codes = [Path.MOVETO]+[Path.LINETO]*(len(coords)-2)+[Path.CLOSEPOLY]
+                madeFieldPaths.append(Path(coords,codes))
+        if made > shown:
+            madeLines.stale = madeFields.stale = True
+            shown = made
+
+        if 0 <= i < m:
+            newLine.set_data(lines[i][0],lines[i][1])
+            newFields.set_verts(fields[i])
+        else:
+            newLine.set_data([],[])
+            newFields.set_verts([])
 
-            for edge in newedges:
-                plt.plot(edge[0],edge[1],'r-')
-            
-            oldedges += newedges
+        dashes.set_visible(i < m)
 
-            plt.axis('off')
-            plt.savefig(self.outputDir+'depth_{0:02d}.png'.format(depth))
-            plt.clf()
+        # The AP once link i (or the last link) is made
+        if min(i+1,m) <= 0:
+            aptotal = 0
+        else:
+            aptotal = data['aptotal'][min(i,m-1)]
 
-            depth += 1
+        ax.set_title('AP:\n%s'%commaGroup(aptotal),ha='center')
+        if i < frames[0]:
+            writer.skip()
+        else:
+            writer.save(i)
+
+    plt.close(fig)
+    return writer.result()
+
+def drawDepth(data,depth):
+    '''
+    Draws image depth of PlanPrinter.split3instruct
+        the edges splitting triangles at that depth are red and the ones before them are black
+        image -1 has only the portals and the last one has every edge
+    '''
+    portals     = data['portals']
+    depthEdges  = data['depthEdges']
+    colorLetter = data['colorLetter']
+    last = len(depthEdges)
+
+    if 0 <= depth < last:
+#        plt.plot(portals[0],portals[1],'go')
+        plt.plot(portals[0],portals[1],'bo')
+    else:
+        plt.plot(portals[0],portals[1],colorLetter+'o')
+
+    for edges in depthEdges[:max(depth,0)]:
+        for edge in edges:
+            plt.plot(edge[0],edge[1],'k-')
 
-        plt.plot(portals[0],portals[1],self.colorLetter+'o')
+    if 0 <= depth < last:
+        for edge in depthEdges[depth]:
+            plt.plot(edge[0],edge[1],'r-')
 
-        for edge in oldedges:
-            plt.plot(edge[0],edge[1],'k-')
+    plt.axis('off')
 
-        plt.axis('off')
-        plt.savefig(self.outputDir+'depth_%s.png'%depth)
+def drawDepths(data,depths,out=None):
+    # Saves the images of PlanPrinter.split3instruct with a FrameWriter(data,fig,out)
+    fig = plt.figure()
+    writer = FrameWriter(data,fig,out)
+    for depth in writer.runFrames(depths):
+        drawDepth(data,depth)
+        if depth < depths[0]:
+            writer.skip()
+        else:
+            writer.save(depth)
         plt.clf()
+    plt.close(fig)
+    return writer.result()
+
+def drawInPool(draw,data,frames,workers=1,out=None):
+    '''
+    Saves the images by calling draw(data,run,out) on runs of consecutive frames
+    workers > 1 splits the frames among that many processes
+        data is pickled to them, so it should only hold what draw needs
+        a run drawn in another process returns the (size,data) of its encoded frames instead
+        which are passed to out, in order, as soon as the runs before them are
+    '''
+    if workers <= 1:
+        draw(data,frames,out)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Short runs let the first ones be written out while the later ones are still drawn
+        nruns = min(4*workers,len(frames))
+        runs = [ frames[k*len(frames)//nruns:(k+1)*len(frames)//nruns] for k in xrange(nruns) ]
+        results = [ pool.apply_async(draw,(data,run)) for run in runs ]
+        for result in results:
+            encoded = result.get()
+            if out != None:
+                out(*encoded)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def drawAnimation(draw,data,frames,workers,name):
+    '''
+    Saves the images of animateFrames or drawDepths with drawInPool
+        with data['animation'] they are written into the file name+extension as they are made
+    '''
+    format = data['animation']
+    if format == None:
+        drawInPool(draw,data,frames,workers)
+        return
+
+    movie = animation.Writer(name+animation.EXTENSIONS[format],format,len(frames))
+    try:
+        drawInPool(draw,data,frames,workers,movie.add)
+    finally:
+        movie.close()
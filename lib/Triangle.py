@@ -2,35 +2,50 @@
 import geometry
 np = geometry.np
 
+# Splitting portals are chosen from this many random candidates
+SPLIT_CANDIDATES = 3
+# Once a final vertex expects this many outgoing links, every candidate is considered
+LOADED = 3
+
 class Deadend(Exception):
     def __init__(self,s):
         self.explain = s
 
 def try_ordered_edge(a,p,q,reversible):
-    if a.has_edge(p,q) or a.has_edge(q,p):
+    '''
+    a is a PlanGraph
+    Links p to q. A reversible link may be made either way, and the direction can change later:
+        it goes out of whichever of p and q has fewer outgoing links
+        a portal with 8 outgoing links gets room by reversing one of its reversible links (PlanGraph.freeOutgoing)
+    The non-reversible links, made by final vertices, need that room
+    '''
+    if a.hasLink(p,q):
         return
 
-#    if reversible and a.out_degree(p) > a.out_degree(q):
-#        p,q = q,p
+    # Keep the outgoing links spread out. Non-reversible links will need the room
+    if reversible and a.outdeg[p] > a.outdeg[q]:
+        p,q = q,p
 
-    if a.out_degree(p) >= 8:
+    if a.outdeg[p] >= 8 and not a.freeOutgoing(p):
         if not reversible:
 #            print '%s already has 8 outgoing'%p
             raise(Deadend('%s already has 8 outgoing'%p))
-        if a.out_degree(q) >= 8:
+        if a.outdeg[q] >= 8 and not a.freeOutgoing(q):
 #            print '%s and %s already have 8 outgoing'%(p,q)
             raise(Deadend('%s and %s already have 8 outgoing'%(p,q)))
         p,q = q,p
     
-    m = a.size()
-    a.add_edge(p,q,{'order':m,'reversible':reversible,'fields':[]})
-
-    try:
-        a.edgeStack.append( (p,q) )
-    except AttributeError:
-        a.edgeStack = [ (p,q) ]
+    a.addEdge(p,q,reversible)
 #    print 'adding',p,q
-#    print a.edgeStack
+
+def triangleBits(sides,v0,v1,v2):
+    # Bitset of the portals inside v0,v1,v2 from the containment index geometry.sideSets
+    # They are on the same side of each edge as the opposite vertex
+    if sides[v1][v2] >> v0 & 1:
+        # counter-clockwise
+        return sides[v0][v1] & sides[v1][v2] & sides[v2][v0]
+    else:
+        return sides[v1][v0] & sides[v2][v1] & sides[v0][v2]
 
 class Triangle:
     def __init__(self,verts,a,exterior=False):
@@ -39,43 +54,117 @@ class Triangle:
         verts[0] should be the final one used in linking
         exterior should be set to true if this triangle has no triangle parent
             the orientation of the outer edges of exterior Triangles do not matter
+            their final vertex is picked by randSplit
+
+        a is the PlanGraph the links are made in while planning
+            once the plan is finished it is the networkx.DiGraph holding the plan
         '''
-        # If this portal is exterior, the final vertex doesn't matter
         self.verts = list(verts)
         self.a = a
         self.exterior = exterior
 
-        if exterior:
-            # Randomizing should help prevent perimeter nodes from getting too many links
-            final = np.random.randint(3)
-            tmp = self.verts[final]
-            self.verts[final] = self.verts[0]
-            self.verts[0] = tmp
-
-        self.pts = np.array([a.node[p]['xyz'] for p in verts])
+        self.pts = a.xyz[verts]
+        self.orths = None
         self.children = []
         self.contents = []
+        self.contentBits = 0
         self.center = None
 
-    def findContents(self,candidates=None):
+    def findContents(self,candidates=None,candidateBits=-1):
+        '''
+        candidates is a list of the portals that might be inside (default all)
+        candidateBits is the same set as a bitset (default all)
+            Only used with the containment index self.a.sides
+        '''
+        if self.a.sides is not None:
+            self.findContentsIndexed(candidateBits)
+            return
+
         if candidates == None:
             candidates = xrange(self.a.order())
-        for p in candidates:
-            if p in self.verts:
-                continue
-            if geometry.sphereTriContains(self.pts,self.a.node[p]['xyz']):
-                self.contents.append(p)
+        candidates = [ p for p in candidates if p not in self.verts ]
+        if len(candidates) == 0:
+            return
+
+        # All the candidates are tested in one go
+        inside = geometry.sphereTrisContain(self.normals(),self.a.xyz[candidates])[0]
+        self.contents = [ p for p,isin in zip(candidates,inside) if isin ]
+
+    def findContentsIndexed(self,candidateBits):
+        bits = triangleBits(self.a.sides,*self.verts)
+        self.contentBits = bits & candidateBits
+        self.contents = geometry.bitsToList(self.contentBits)
+
+    def randSplit(self,rng=np.random,load=None):
+        '''
+        Splits this triangle and its descendants on randomly chosen portals
+
+        load[p] is the number of outgoing links p is expected to have
+            It starts from the links already in the graph
+        The final vertex makes a non-reversible link to every portal its triangles are split on
+        so the random choices are steered away from piling those onto one portal
+        '''
+        if load is None:
+            load = self.a.outdeg.tolist()
+
+        if self.exterior:
+            self.chooseFinal(load,rng)
 
-    def randSplit(self):
         if len(self.contents) == 0:
             return
-        
-        p = self.contents[np.random.randint(len(self.contents))]
+
+        if self.a.sides is None:
+            p = self.contents[rng.randint(len(self.contents))]
+        else:
+            p = self.chooseSplit(load,rng)
         
         self.splitOn(p)
+        load[self.verts[0]] += 1
 
         for child in self.children:
-            child.randSplit()
+            child.randSplit(rng,load)
+
+    def chooseFinal(self,load,rng):
+        # Make the least loaded vertex final, unless both its links are already made
+        # This keeps perimeter portals from getting too many outgoing links
+        costs = [ load[self.verts[i]] for i in range(3) ]
+        for i in range(3):
+            if self.a.hasLink(self.verts[i],self.verts[i-1]) and \
+               self.a.hasLink(self.verts[i],self.verts[i-2]):
+                costs[i] = np.inf
+
+        # Ties are broken randomly
+        least = [ i for i in range(3) if costs[i] == min(costs) ]
+        final = least[rng.randint(len(least))]
+
+        tmp = self.verts[final]
+        self.verts[final] = self.verts[0]
+        self.verts[0] = tmp
+
+    def chooseSplit(self,load,rng):
+        '''
+        Every portal left inside the two children that share the final vertex
+        will cost the final vertex another outgoing link
+        So the split is the candidate leaving the fewest portals there
+        Needs the containment index self.a.sides to count them
+        '''
+        v0,v1,v2 = self.verts
+        if len(self.contents) <= SPLIT_CANDIDATES or load[v0] >= LOADED:
+            candidates = self.contents
+        else:
+            candidates = [ self.contents[rng.randint(len(self.contents))]\
+                           for i in xrange(SPLIT_CANDIDATES) ]
+
+        best = None
+        for p in candidates:
+            adjacent = triangleBits(self.a.sides,v0,v2,p) | \
+                       triangleBits(self.a.sides,v0,v1,p)
+            cost = bin(adjacent & self.contentBits).count('1')
+            if best == None or cost < bestcost:
+                best = p
+                bestcost = cost
+
+        return best
 
     def nearSplit(self):
         # Split on the node closest to final
@@ -108,7 +197,7 @@ class Triangle:
         self.center = p
 
         for child in self.children:
-            child.findContents(self.contents)
+            child.findContents(self.contents,self.contentBits)
 
     def tostr(self):
         # Just a string representation of the triangle
@@ -151,21 +240,21 @@ class Triangle:
     def buildGraph(self):
 #        print 'building',self.tostr()
         # A first generation triangle could have its final vertex's edges already completed by neighbors. This will cause the first generation to be completed when the opposite edge is added which complicates  completing inside descendents. This could be solved by choosing a new final vertex (or carefully choosing the order of completion of first generation triangles).
-        if (                                                \
-            self.a.has_edge(self.verts[0],self.verts[1]) or \
-            self.a.has_edge(self.verts[1],self.verts[0])    \
-           ) and                                            \
-           (                                                \
-            self.a.has_edge(self.verts[0],self.verts[2]) or \
-            self.a.has_edge(self.verts[2],self.verts[0])    \
-           ):
+        if self.a.hasLink(self.verts[0],self.verts[1]) and \
+           self.a.hasLink(self.verts[0],self.verts[2]):
 #            print 'Final vertex completed!!!'
             raise Deadend('Final vertex completed by neighbors')
         self.buildExceptFinal()
         self.buildFinal()
 
+    def normals(self):
+        # Edge normals from geometry.triNormals, computed the first time they are needed
+        if self.orths is None:
+            self.orths = geometry.triNormals(self.pts)
+        return self.orths
+
     def contains(self,pt):
-        return np.all(np.sum(self.orths*(pt-self.pts),1) < 0)
+        return geometry.sphereTrisContain(self.normals(),pt)[0,0]
 
     # Attach to each edge a list of fields that it completes
     def markEdgesWithFields(self):
@@ -1,5 +1,6 @@
 import geometry
 import numpy as np
+import multiprocessing
 
 import orderedTSP
 
@@ -139,8 +140,24 @@ def expandOrder(s,mult):
 
     return order
 
-def getAgentOrder(a,nagents,orderedEdges):
+def portalDists(a):
     '''
+    The matrix of distances (in meters) between the portals of the plan a
+        It is computed once and kept in a.dists for everyone else (but not in the .pkl)
+    '''
+    try:
+        return a.dists
+    except AttributeError:
+        geo = np.array([a.node[i]['geo'] for i in xrange(a.order())])
+        a.dists = geometry.sphereDist(geo,geo)
+        return a.dists
+
+def getAgentOrder(a,nagents,orderedEdges,d=None,engine='beam',workers=1):
+    '''
+    d is the distance matrix between the portals (default portalDists(a))
+    engine is the search orderedTSP.getVisits uses, one of orderedTSP.ENGINES
+    workers is the number of processes it may use
+
     returns visits
     visits[i] = j means agent j should make edge i
     
@@ -153,15 +170,15 @@ def getAgentOrder(a,nagents,orderedEdges):
     Time spent navigating linking menu
         a.linktime
     '''
-    geo = np.array([a.node[i]['geo'] for i in xrange(a.order())])
-    d = geometry.sphereDist(geo,geo)
+    if d is None:
+        d = portalDists(a)
 #    print d
     order = [e[0] for e in orderedEdges]
 
     # Reduce sequences of links made from same portal to single entry
     condensed, mult = condenseOrder(order)
 
-    link2agent, times = orderedTSP.getVisits(d,condensed,nagents)
+    link2agent, times = orderedTSP.getVisits(d,condensed,nagents,engine,workers)
 
     # Expand links made from same portal to original count
     link2agent = expandOrder(link2agent,mult)
@@ -188,6 +205,71 @@ def getAgentOrder(a,nagents,orderedEdges):
 
     return movements
 
+# (a,orderedEdges,engine,workers) set in each process by initSweep
+_sweep = None
+
+def initSweep(a,orderedEdges,engine='beam',workers=1):
+    global _sweep
+    _sweep = (a,orderedEdges,engine,workers)
+
+def sweepOne(nagents):
+    a,orderedEdges,engine,workers = _sweep
+    movements = getAgentOrder(a,nagents,orderedEdges,None,engine,workers)
+    return movements,a.walktime,a.commtime,a.linktime
+
+def sweepAgents(a,counts,orderedEdges,workers=1,engine='beam'):
+    '''
+    Schedules the plan a for each number of agents in counts
+        The distance matrix is computed once for all of them
+    workers > 1 schedules that many counts at once in separate processes
+        With a single count they are given to the search instead
+    engine is the search orderedTSP.getVisits uses, one of orderedTSP.ENGINES
+
+    returns a dict schedules[nagents] = (movements,walktime,commtime,linktime)
+        a's time attributes should be set from the chosen one afterwards
+    '''
+    # The workers get the distance matrix along with a
+    portalDists(a)
+
+    if workers > 1 and len(counts) > 1:
+        pool = multiprocessing.Pool(workers,initSweep,(a,orderedEdges,engine))
+        try:
+            results = pool.map(sweepOne,counts)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        initSweep(a,orderedEdges,engine,workers)
+        results = [ sweepOne(nagents) for nagents in counts ]
+
+    return dict(zip(counts,results))
+
+def chooseAgents(schedules,target=None):
+    '''
+    schedules is the output of sweepAgents
+    target is the number of seconds the operation should take
+
+    returns the smallest number of agents that finishes within target
+        or the number that finishes soonest if none do (or there is no target)
+    '''
+    total = lambda n: sum(schedules[n][1:])
+    counts = sorted(schedules)
+    if target is not None:
+        for n in counts:
+            if total(n) <= target:
+                return n
+    return min(counts,key=total)
+
+def sweepTable(schedules):
+    # Lines of a table comparing the times (in minutes) for each number of agents
+    rowFormat = '{0:>6} | {1:>6} | {2:>6} | {3:>6} | {4:>6}'
+    lines = [ rowFormat.format('Agents','Walk','Comm','Link','Total') ]
+    lines.append( '-'*len(lines[0]) )
+    for n in sorted(schedules):
+        times = [ t/60. for t in schedules[n][1:] ]
+        lines.append( rowFormat.format(n,*[ '%.1f'%t for t in times+[sum(times)] ]) )
+    return lines
+
 #    m = a.size()
 #
 #    # link2agent[j] is the agent who makes link j
@@ -233,6 +315,12 @@ def improveEdgeOrder(a):
         The relative order of edges that complete fields is unchanged
         Edges that do not complete fields may only be completed earlier
         Where possible, non-completing edges are made immediately before another edge with same origin
+        Otherwise they are made immediately before the first edge from the nearest portal used earlier
+
+    The edges are kept in a linked list so each move takes constant time
+        after[e] and before[e] are the edges after and before edge e
+        edge m is the head and tail of the list
+    firstUse[p] is the earliest edge in the list with origin p
     '''
     m = a.size()
     # If link i is e then orderedEdges[i]=e
@@ -241,35 +329,48 @@ def improveEdgeOrder(a):
     for p,q in a.edges_iter():
         orderedEdges[a.edge[p][q]['order']] = (p,q)
 
-    for j in xrange(1,m):
+    # Each portal's neighbors from nearest to farthest, only looked at when needed
+    dists = portalDists(a)
+    nearest = {}
+
+    after  = [m]*(m+1)
+    before = [m]*(m+1)
+    firstUse = {}
+
+    def insertBefore(e,f):
+        # Put edge e just before edge f
+        before[e] = before[f]
+        after [e] = f
+        after [before[f]] = e
+        before[f] = e
+
+    for j in xrange(m):
         p,q = orderedEdges[j]
         # Only move those that don't complete fields
         if len(a.edge[p][q]['fields']) > 0:
-            continue
-
-#        print j,p,q,a.edge[p][q]['fields']
-
-        origin = orderedEdges[j][0]
-        # The first time this portal is used as an origin
-        i = 0
-        while orderedEdges[i][0]!=origin:
-            i+=1
-
-        if i<j:
-            #print 'moving %s before %s'%(orderedEdges[j],orderedEdges[i])
-            # Move link j to be just before link i
-            orderedEdges =  orderedEdges[   :i] +\
-                           [orderedEdges[  j  ]]+\
-                            orderedEdges[i  :j] +\
-                            orderedEdges[j+1: ]
-        #TODO else: choose the closest earlier portal
+            insertBefore(j,m)
+        elif p in firstUse:
+            #print 'moving %s before %s'%(orderedEdges[j],orderedEdges[firstUse[p]])
+            insertBefore(j,firstUse[p])
+        else:
+            # Choose the closest earlier portal
+            if p not in nearest:
+                nearest[p] = np.argsort(dists[p])
+            for r in nearest[p]:
+                if r in firstUse:
+                    insertBefore(j,firstUse[r])
+                    break
+            else:
+                insertBefore(j,m)
+
+        if p not in firstUse or firstUse[p] == after[j]:
+            firstUse[p] = j
     
-#    print 
+    e = after[m]
     for i in xrange(m):
-        p,q = orderedEdges[i]
-#        print p,q,a.edge[p][q]['fields']
+        p,q = orderedEdges[e]
         a.edge[p][q]['order'] = i
-#    print
+        e = after[e]
 
 if __name__=='__main__':
     order = [0,5,5,5,2,2,1,0]
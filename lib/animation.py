@@ -0,0 +1,197 @@
+
+import zlib
+import struct
+import numpy as np
+from PIL import Image
+
+# The formats of single-file animations
+FORMATS = ['gif','apng']
+# File name extension for each format
+EXTENSIONS = {'gif':'.gif', 'apng':'.png'}
+
+# Milliseconds each frame is shown, and the last one before starting over
+FRAME_MS = 500
+LAST_FRAME_MS = 3000
+
+def toPalette(image):
+    # Every gif frame uses the same web-safe palette, so it is only written once per file
+    return image.convert('P',dither=Image.NONE,palette=Image.WEB)
+
+# The colors of the web-safe palette as 768 bytes
+PALETTE = bytes(bytearray(toPalette(Image.new('RGB',(1,1))).getpalette()))
+
+def figureImage(fig):
+    # The figure as drawn by its Agg canvas, in RGB
+    fig.canvas.draw()
+    size = fig.canvas.get_width_height()
+    return Image.frombytes('RGB',size,fig.canvas.tostring_rgb())
+
+def pngChunk(kind,data):
+    return struct.pack('>I',len(data)) + kind + data + \
+           struct.pack('>I',zlib.crc32(kind+data) & 0xffffffff)
+
+def lzw(pixels):
+    '''
+    The GIF image data of a run of palette indices (at least one): the minimum code size,
+    then the variable length LZW codes in sub-blocks of up to 255 bytes
+    '''
+    clear,end = 256,257
+    out = bytearray()
+
+    # Starting with a clear code tells the reader the table is empty
+    table = {}
+    size,nextCode = 9,258
+    bits,nbits = clear,size
+
+    pixels = bytearray(pixels)
+    w = pixels[0]
+    for k in pixels[1:]:
+        code = table.get((w,k))
+        if code is not None:
+            w = code
+            continue
+
+        bits |= w << nbits
+        nbits += size
+        while nbits >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            nbits -= 8
+
+        if nextCode < 4096:
+            table[(w,k)] = nextCode
+            nextCode += 1
+            # A reader adds each entry one code later, so codes only widen once nextCode-1 needs it
+            if nextCode > 1 << size:
+                size += 1
+        else:
+            # The table is full, start over
+            bits |= clear << nbits
+            nbits += size
+            table = {}
+            size,nextCode = 9,258
+        w = k
+
+    bits |= (w | end << size) << nbits
+    nbits += 2*size
+    while nbits > 0:
+        out.append(bits & 0xff)
+        bits >>= 8
+        nbits -= 8
+
+    blocks = [ chr(8) ]
+    for i in xrange(0,len(out),255):
+        block = out[i:i+255]
+        blocks.append(chr(len(block)) + str(block))
+    blocks.append('\x00')
+    return ''.join(blocks)
+
+def header(format,size,nframes):
+    '''
+    The start of an animation file of nframes frames with size (width,height)
+    Write it, then the output of FrameEncoder.add for every frame in order, then trailer(format)
+        (Writer does this)
+    '''
+    width,height = size
+    if format == 'gif':
+        return 'GIF89a' + struct.pack('<HHBBB',width,height,0xf7,0,0) + PALETTE + \
+               '!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H',0) + '\x00' # loop forever
+
+    # 8 bit RGB image, so the apng keeps every color of the figure
+    return '\x89PNG\r\n\x1a\n' + \
+           pngChunk('IHDR',struct.pack('>IIBBBBB',width,height,8,2,0,0,0)) + \
+           pngChunk('acTL',struct.pack('>II',nframes,0))
+
+def trailer(format):
+    if format == 'gif':
+        return ';'
+    return pngChunk('IEND','')
+
+class FrameEncoder:
+    '''
+    Encodes each frame as the rectangle that changed since the frame before
+    add() returns the bytes of a frame, which go into the file in order
+
+    The frames can be encoded in separate runs (in worker processes)
+        a run that doesn't start with the first frame should be shown the frame before it with skip()
+    '''
+    def __init__(self,format):
+        self.format = format
+        self.previous = None
+
+    def pixels(self,image):
+        # The gif only has the shared palette
+        if self.format == 'gif':
+            image = toPalette(image)
+        return np.asarray(image)
+
+    def skip(self,image):
+        self.previous = self.pixels(image)
+
+    def add(self,image,duration,position):
+        '''
+        image is the frame in RGB (from figureImage)
+        duration is the number of milliseconds it is shown
+        position is its index in the file, the first frame being 0
+        '''
+        pixels = self.pixels(image)
+        if position == 0 or self.previous is None:
+            # The first frame is whole
+            left,top,right,bottom = 0,0,pixels.shape[1],pixels.shape[0]
+        else:
+            changed = pixels != self.previous
+            if changed.ndim == 3:
+                changed = changed.any(2)
+            rows = np.flatnonzero(changed.any(1))
+            cols = np.flatnonzero(changed.any(0))
+            if len(rows) == 0:
+                # The same image again. Formats need a rectangle, so one pixel is repeated
+                left,top,right,bottom = 0,0,1,1
+            else:
+                left,top,right,bottom = cols[0],rows[0],cols[-1]+1,rows[-1]+1
+        self.previous = pixels
+
+        region = pixels[top:bottom,left:right]
+        if self.format == 'gif':
+            # Graphic control extension: left in place (disposal 1) after duration in hundredths of a second
+            control = '!\xf9\x04' + struct.pack('<BHBB',1<<2,int(round(duration/10.)),0,0)
+            # Image descriptor, using the global palette
+            descriptor = ',' + struct.pack('<HHHHB',left,top,right-left,bottom-top,0)
+            return control + descriptor + lzw(region.tostring())
+
+        # Each row starts with the filter type, 0 for none
+        rows = np.hstack([np.zeros([bottom-top,1],dtype=np.uint8),region.reshape(bottom-top,-1)])
+        data = zlib.compress(rows.tostring())
+
+        # Sequence numbers count the fcTL and fdAT chunks. Every frame has one of each, except the first
+        # whose data is the IDAT of the default image
+        sequence = max(2*position-1,0)
+        control = pngChunk('fcTL',struct.pack('>IIIIIHHBB',sequence,right-left,bottom-top,left,top,\
+                                                          duration,1000,0,0))
+        if position == 0:
+            return control + pngChunk('IDAT',data)
+        return control + pngChunk('fdAT',struct.pack('>I',sequence+1)+data)
+
+class Writer:
+    '''
+    Writes an animation file of nframes frames as they are encoded
+        add(size,data) appends data, the output of FrameEncoder.add for the next frames
+        size is the (width,height) of the images, the same for all of them
+    close() finishes the file
+    '''
+    def __init__(self,filename,format,nframes):
+        self.format  = format
+        self.nframes = nframes
+        self.fout    = open(filename,'wb')
+        self.started = False
+
+    def add(self,size,data):
+        if not self.started:
+            self.fout.write(header(self.format,size,self.nframes))
+            self.started = True
+        self.fout.write(data)
+
+    def close(self):
+        if self.started:
+            self.fout.write(trailer(self.format))
+        self.fout.close()
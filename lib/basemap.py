@@ -0,0 +1,189 @@
+
+import os
+import math
+import errno
+import socket
+import hashlib
+import sqlite3
+import urllib2
+from cStringIO import StringIO
+from PIL import Image
+
+# Map images from the network are kept here, so the same plan never fetches one twice
+CACHE_DIR = os.path.join(os.path.expanduser('~'),'.maxfield','maps')
+# Seconds to wait for a map server before going on without a background
+TIMEOUT = 10
+# Width and height of a web mercator tile
+TILESIZE = 256
+
+class MapUnavailable(Exception):
+    pass
+
+# A provider makes the background image for PlanPrinter.planMap with
+#     provider.image(latcenter,loncenter,zoom,xwidth,ywidth)
+#         the center is in degrees
+#         zoom is a web mercator zoom level (the world is 256*2**zoom pixels wide)
+#         xwidth,ywidth are the size of the image in pixels
+#     it returns a PIL Image or raises MapUnavailable
+# provider.name keeps the cached images of different providers apart
+
+class GoogleMaps:
+    name = 'google'
+
+    def __init__(self,timeout=TIMEOUT):
+        self.timeout = timeout
+
+    def image(self,latcenter,loncenter,zoom,xwidth,ywidth):
+        url = "http://maps.googleapis.com/maps/api/staticmap?center={0},{1}&size={2}x{3}&zoom={4}&sensor=false".format(latcenter,loncenter,xwidth,ywidth,zoom)
+        try:
+            data = urllib2.urlopen(url,timeout=self.timeout).read()
+            return Image.open(StringIO(data))
+        except (IOError,socket.error) as e:
+            # This includes urllib2.URLError and timeouts
+            raise MapUnavailable('could not get the Google map: %s'%e)
+
+def mercatorPixel(lat,lon,zoom):
+    # Position of lat,lon (in degrees) in the web mercator world image at zoom
+    worldsize = TILESIZE * 2.**zoom
+    siny = math.sin(math.radians(lat))
+    x = (lon+180.)/360. * worldsize
+    y = (.5 - math.log((1+siny)/(1-siny))/(4*math.pi)) * worldsize
+    return x,y
+
+def tilesName(kind,path,mtime):
+    '''
+    The cache name of the tiles at path, last changed at mtime
+        the hashed absolute path keeps tile sets with the same file name apart
+        and the time makes an updated tile set get new images
+    '''
+    path = os.path.abspath(path)
+    if isinstance(path,unicode):
+        path = path.encode('utf-8')
+    return '{0}-{1}-{2}-{3}'.format(kind,os.path.splitext(os.path.basename(path))[0],\
+                                    hashlib.sha1(path).hexdigest()[:12],int(mtime))
+
+class LocalTiles:
+    '''
+    Composites the image from web mercator tiles on disk
+    Subclasses read a tile with self.tile(zoom,x,y), returning its bytes or None
+        x counts east from longitude -180 and y counts south from the top, as in XYZ tile URLs
+    Missing tiles are left blank
+    '''
+    def image(self,latcenter,loncenter,zoom,xwidth,ywidth):
+        cx,cy = mercatorPixel(latcenter,loncenter,zoom)
+        left = int(round(cx - xwidth/2.))
+        top  = int(round(cy - ywidth/2.))
+        ntiles = 2**zoom
+
+        image = Image.new('RGB',(xwidth,ywidth),(255,255,255))
+        found = 0
+        for ty in xrange(top//TILESIZE,(top+ywidth-1)//TILESIZE+1):
+            if ty < 0 or ty >= ntiles:
+                continue
+            for tx in xrange(left//TILESIZE,(left+xwidth-1)//TILESIZE+1):
+                # The world wraps around in longitude
+                data = self.tile(zoom,tx%ntiles,ty)
+                if data is None:
+                    continue
+                try:
+                    tile = Image.open(StringIO(data)).convert('RGB')
+                except IOError:
+                    continue
+                image.paste(tile,(tx*TILESIZE-left,ty*TILESIZE-top))
+                found += 1
+
+        if found == 0:
+            raise MapUnavailable('%s has no tiles for zoom %s here'%(self.path,zoom))
+        return image
+
+class TileDirectory(LocalTiles):
+    # Tiles in files named <path>/<zoom>/<x>/<y>.png (or .jpg)
+    def __init__(self,path):
+        self.path = path
+        # Adding or replacing a tile file changes the time of its <zoom>/<x> directory
+        mtime = max([ os.path.getmtime(d) for d,dirs,files in os.walk(path) ])
+        self.name = tilesName('tiles',os.path.normpath(path),mtime)
+
+    def tile(self,zoom,x,y):
+        for ext in ['.png','.jpg','.jpeg']:
+            filename = os.path.join(self.path,str(zoom),str(x),str(y)+ext)
+            if os.path.exists(filename):
+                with open(filename,'rb') as fin:
+                    return fin.read()
+        return None
+
+class MBTiles(LocalTiles):
+    # Tiles in an MBTiles (sqlite) file, whose rows count north from the bottom
+    def __init__(self,path):
+        self.path = path
+        # sqlite would make an empty database for a wrong name
+        if not os.path.isfile(path):
+            raise MapUnavailable('%s is not a tile directory or .mbtiles file'%path)
+        self.name = tilesName('mbtiles',path,os.path.getmtime(path))
+        try:
+            self.db = sqlite3.connect(path)
+        except sqlite3.Error as e:
+            raise MapUnavailable('could not open %s: %s'%(path,e))
+
+    def tile(self,zoom,x,y):
+        try:
+            row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',\
+                                  (zoom,x,2**zoom-1-y)).fetchone()
+        except sqlite3.Error as e:
+            raise MapUnavailable('could not read %s: %s'%(self.path,e))
+        if row is None:
+            return None
+        return str(row[0])
+
+def localTiles(path):
+    # The provider for an .mbtiles file or a directory of tiles
+    if os.path.isdir(path):
+        return TileDirectory(path)
+    return MBTiles(path)
+
+class Cached:
+    '''
+    Keeps the images of provider in cacheDir
+        they are named by the provider, center, zoom and size, so a plan gets the same one every time
+    '''
+    def __init__(self,provider,cacheDir=CACHE_DIR):
+        self.provider = provider
+        self.name = provider.name
+        self.cacheDir = cacheDir
+
+    def image(self,latcenter,loncenter,zoom,xwidth,ywidth):
+        filename = os.path.join(self.cacheDir,'{0}_{1:.6f}_{2:.6f}_{3}_{4}x{5}.png'.format(\
+                        self.name,latcenter,loncenter,zoom,xwidth,ywidth))
+        if os.path.exists(filename):
+            try:
+                return Image.open(filename)
+            except IOError:
+                # A broken file is fetched again
+                pass
+
+        image = self.provider.image(latcenter,loncenter,zoom,xwidth,ywidth)
+
+        # The cache is only a convenience. Failing to write it doesn't stop the plan
+        try:
+            os.makedirs(self.cacheDir)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                return image
+        try:
+            # Written under another name first so that an interrupted run leaves no half image
+            partial = filename+'.part'
+            image.save(partial,'PNG')
+            os.rename(partial,filename)
+        except (IOError,OSError):
+            pass
+
+        return image
+
+def choose(tiles=None):
+    '''
+    The cached provider for the maps: the local tiles at path tiles, or else Google maps
+        raises MapUnavailable if tiles can't be read
+    '''
+    if tiles is None:
+        return Cached(GoogleMaps())
+    return Cached(localTiles(tiles))
@@ -1,5 +1,6 @@
 
 import numpy as np
+import multiprocessing
 
 class CantSplit(Exception):
     pass
@@ -11,12 +12,75 @@ class InfState:
     def split(self,num):
         raise CantSplit()
 
-def branch_bound(root,lo,hi):
+def ranked(states):
+    # The states sorted by value. Ties keep their order, so a part of the states ranks the same way alone
+    return np.array(states)[np.argsort([ state.value for state in states ],kind='mergesort')]
+
+def undominated(states,lo):
+    '''
+    states should be sorted by value
+    returns the first lo of them that are not dominated by an earlier one
+        Only states with the same key() are compared, with dominates()
+    '''
+    kept = []
+    groups = {}
+    for state in states:
+        group = groups.setdefault(state.key(),[])
+        if any(other.dominates(state) for other in group):
+            continue
+        group.append(state)
+        kept.append(state)
+        if len(kept) >= lo:
+            break
+    return kept
+
+def dive(root):
+    '''
+    Follows the best child down from root to a state that can't be split
+    returns that state, a first solution to compare the others against
+    '''
+    state = root
+    while True:
+        try:
+            state.split(1)
+        except CantSplit:
+            return state
+        state = state.children[0]
+
+# The root of the search, set in each worker process by initWorker
+_root = None
+
+def initWorker(root):
+    global _root
+    _root = root
+
+def splitChunk(states,splitSize):
+    '''
+    Runs in the worker processes of branch_bound
+    The states come without the data they share with the root
+    Children dominated by another child of the chunk are not sent back
+        branch_bound would drop them anyway, and unpickling them costs about as much as making them
+    '''
+    for state in states:
+        state.share(_root)
+        state.split(splitSize)
+
+    if hasattr(_root,'dominates'):
+        branches = [ child for state in states for child in state.children ]
+        kept = set( id(child) for child in undominated(ranked(branches),len(branches)) )
+        for state in states:
+            state.children = [ child for child in state.children if id(child) in kept ]
+
+    return [ state.children for state in states ]
+
+def branch_bound(root,lo,hi,workers=1):
     '''
     Uses a branch-and-bound style approach to minimize a function
 
     hi: maximum number of branches to obtain at each level
     lo: number of branches to explore further
+    workers: number of processes splitting the states (default 1, this process)
+        no more than the number of cores are used
 
     root: is an instance of a state class with callable nextstate()
         nextstate() should:
@@ -25,6 +89,22 @@ def branch_bound(root,lo,hi):
         each member of root.children should also be a state class
         members of root.values correspond to members of root.children
 
+        States may also have callable key() and dominates(other)
+            States with equal keys are duplicates, or one may be no better than the other
+            s.dominates(other) should be True if other can never reach a lower value than s
+            Dominated states are dropped before the best lo are chosen
+
+        States may also have callable bound()
+            a lower bound on the value of any state that can be reached from it
+            The best child is followed down first to get an incumbent
+            States that can't beat the incumbent are dropped
+
+        With workers > 1 the states are pickled to the workers and their children are pickled back
+            States should leave the data they all share out of their pickles, except for the root
+            The root is sent to each worker once, when the worker starts
+            state.share(root) gives a state sent to a worker the data it shares with the root
+            state.adopt(children) gives the children sent back that data, and links them up
+
     returns s,v (the state and lowest found value)
     '''
     # number of branches to make from each branch
@@ -33,28 +113,70 @@ def branch_bound(root,lo,hi):
 
     states = np.array([root])
 
-    if splitSize != 1:
-        print 'Planning agent movements:'
-
-    # This is only for the printout
-    counter = 0
-    while True:
-        # The branches of the states
-        try:
+    # The workers get the root before the dive hangs a line of children from it
+    # Each level's children are pickled, so processes sharing a core only slow it down
+    workers = min(workers,multiprocessing.cpu_count())
+    if workers > 1:
+        pool = multiprocessing.Pool(workers,initWorker,(root,))
+    else:
+        pool = None
+
+    try:
+        if hasattr(root,'bound'):
+            incumbent = dive(root)
+        else:
+            incumbent = None
+
+        if splitSize != 1:
+            print 'Planning agent movements:'
+
+        # This is only for the printout
+        counter = 0
+        while True:
+            # The branches of the states
+            try:
+                if pool == None:
+                    for state in states:
+                        state.split(splitSize)
+                else:
+                    # Some states have many more branches than others, so there are more chunks than workers
+                    chunks = np.array_split(states,min(4*workers,len(states)))
+                    results = [ pool.apply_async(splitChunk,(chunk,splitSize)) for chunk in chunks ]
+                    for chunk,result in zip(chunks,results):
+                        for state,children in zip(chunk,result.get()):
+                            state.children = children
+                            state.adopt(children)
+            except CantSplit:
+                # TODO For now, assume all states finish splitting at the same time
+                break
+
+            # States may make fewer children than asked
+            branches = np.array([child for state in states for child in state.children])
+
+            # States may point back to their parents. Letting go of the children lets the pruned ones be freed
             for state in states:
-                state.split(splitSize)
-        except CantSplit:
-            # TODO For now, assume all states finish splitting at the same time
-            break
-
-        branches = np.array([state.children for state in states])
-        branches.shape = (-1)
+                state.children = []
 
-        branchvalues = [branch.value for branch in branches]
-        bestlo = np.argsort(branchvalues)[:lo]
-        states = branches[bestlo]
-        if splitSize != 1: print counter
-        counter += 1
+            if hasattr(root,'dominates'):
+                states = np.array(undominated(ranked(branches),lo))
+            else:
+                states = ranked(branches)[:lo]
+
+            if incumbent != None:
+                states = np.array([ state for state in states if state.bound() < incumbent.value ])
+                if len(states) == 0:
+                    # Nothing can beat the incumbent
+                    break
+
+            if splitSize != 1: print counter
+            counter += 1
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    if incumbent != None and (len(states) == 0 or incumbent.value <= states[0].value):
+        return incumbent,incumbent.value
     
     return states[0],states[0].value
 
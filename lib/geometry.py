@@ -1,6 +1,7 @@
 
 # Portals, triangles and the like
 
+import binascii
 import numpy as np
 
 radPERe6degree = np.pi / (180*10**6)
@@ -46,43 +47,51 @@ def greatArcAng(x,y):
     '''
     x,y should be nx2 arrays expressing latitude,longitude (in radians)
     Great arc angle between x and y (in radians)
+        angles[j,i] is the angle between y[j] and x[i]
     '''
 
     # If either is a single point (not in a list) return a 1-d array
     flatten = y.ndim==1 or x.ndim==1
 
     # Formula taken from Wikipedia, accurate for distances great and small
-    x = x.reshape([-1,2])
-    y = y.reshape([-1,2])
-    
-    nx = x.shape[0]
-    ny = y.shape[0]
+    x = np.asarray(x,dtype=float).reshape([-1,2])
+    y = np.asarray(y,dtype=float).reshape([-1,2])
 
-    # After reshaping, arithmetic operators produce distance-style matrices
-    latx = np.tile(x[:,0],[ny,1])
-    lngx = np.tile(x[:,1],[ny,1])
-    laty = np.tile(y[:,0],[nx,1]).T
-    lngy = np.tile(y[:,1],[nx,1]).T
+    # The latitude terms only need one value per point
+    sinx = np.sin(x[:,0])
+    cosx = np.cos(x[:,0])
 
-    dlng = np.abs(lngx-lngy)
+    # As columns, arithmetic with the x terms broadcasts to distance-style matrices
+    siny = np.sin(y[:,0]).reshape([-1,1])
+    cosy = np.cos(y[:,0]).reshape([-1,1])
 
-    sinx = np.sin(latx)
-    cosx = np.cos(latx)
+    # The sign of the longitude difference doesn't matter once it is squared or in cos
+    dlng = np.subtract(x[:,1],y[:,1].reshape([-1,1]))
 
-    siny = np.sin(laty)
-    cosy = np.cos(laty)
-    
     sind = np.sin(dlng)
-    cosd = np.cos(dlng)
-
-    numer = np.sqrt( (cosx*sind)**2 + (cosy*sinx-siny*cosx*cosd)**2 )
-    denom = siny*sinx + cosy*cosx*cosd
+    cosd = np.cos(dlng,out=dlng)
+
+    # numer = sqrt( (cosx*sind)**2 + (cosy*sinx-siny*cosx*cosd)**2 )
+    numer = np.multiply(cosd,cosx)
+    numer *= siny
+    numer -= cosy*sinx
+    numer **= 2
+    sind *= cosx
+    sind **= 2
+    numer += sind
+    np.sqrt(numer,out=numer)
+
+    # denom = siny*sinx + cosy*cosx*cosd
+    denom = cosd
+    denom *= cosx
+    denom *= cosy
+    denom += siny*sinx
 
     # great arc angle containing x and y
-    angles = np.arctan2(numer,denom)
+    angles = np.arctan2(numer,denom,out=numer)
 
     if flatten:
-        angles.shape = -1
+        angles = angles.reshape(-1)
 
     return angles
 
@@ -91,38 +100,110 @@ def sphereDist(x,y,R=6371000):
     x,y are n x 2 arrays with lattitude, longitude in radians
     '''
     sigma = greatArcAng(x,y)
-    return R*sigma
+    sigma *= R
+    return sigma
 
-def sphereTriContains(pts,x):
+def triNormals(tris):
     '''
-    pts is a 3 x 3 array representing vertices of a triangle
-        pts[i] contains the x,y,z coords of vertex i
-    x is a 2-array representing the test point
+    tris is a T x 3 x 3 array of triangles in xyz format
+        tris[t,i] contains the x,y,z coords of vertex i of triangle t
 
-    points should be represented in xyz format
+    returns normals, a T x 3 x 3 array
+        normals[t,i] is orthogonal to the plane through the origin and the side opposite vertex i
+        it points to the side of that plane vertex i is on (it is 0 if vertex i is on the plane)
+    Keep them to test the same triangles against more points with sphereTrisContain
+    '''
+    tris = tris.reshape([-1,3,3])
 
-    returns True iff x is inside the triangle
+    normals = np.cross( tris[:,[1,2,0]] , tris[:,[2,0,1]] )
+    psign = np.sign(np.sum(normals*tris,2))
+    normals *= psign[:,:,np.newaxis]
+
+    return normals
+
+def sphereTrisContain(normals,x):
+    '''
+    normals is the output of triNormals for T triangles
+    x is an N x 3 array of points in xyz format
+
+    returns a T x N boolean array
+        inside[t,j] is True iff x[j] is inside triangle t
         yes, three points make two triangles, but we assume the small one
 
     behavior in border cases not guaranteed
     '''
     x = x.reshape([-1,3])
 
-    # Find vectors orthogonal to the planes through origin and triangle sides
+    # xsign[t,i,j] is positive iff x[j] is on the same side of side i of triangle t as vertex i
+    xsign = np.dot( normals,x.T )
 
-    crosses = np.cross( pts[[1,2,0]] , pts[[2,0,1]] )
+    return np.all( xsign > 0,1)
 
-    xsign = np.dot( crosses,x.T )
-    psign = np.sum(crosses*pts,1).reshape([3,1])
+def sphereTriContains(pts,x):
+    '''
+    pts is a 3 x 3 array representing vertices of a triangle
+        pts[i] contains the x,y,z coords of vertex i
+    x is an N x 3 array of the test points
 
-    # Check whether opposite vertex is always on same side of plane as x
-    return np.all( xsign*psign > 0,0)
+    points should be represented in xyz format
+
+    returns an N-array, True where x is inside the triangle
+    Many triangles are better tested at once with triNormals and sphereTrisContain
+    '''
+    return sphereTrisContain(triNormals(pts),x)[0]
+
+def sideSets(xyz):
+    '''
+    xyz is an n x 3 array of points on the sphere
+
+    returns sides, a list of lists of bitsets (python integers)
+        bit x of sides[p][q] is set iff x is strictly on the left of the great circle through p,q
+        i.e. the vertices p,q,x go counter-clockwise
+    x is in the (small) triangle p,q,r iff it is on the same side of each edge as the opposite vertex
+    so the contents of a counter-clockwise triangle p,q,r are
+        sides[p][q] & sides[q][r] & sides[r][p]
+
+    This takes O(n^3) arithmetic once so that containment tests while planning are just bitwise ANDs
+    '''
+    n = xyz.shape[0]
+    # Pad rows to whole bytes and reverse them so bit x of the packed integer is point x
+    width = 8*((n+7)//8)
+
+    sides = []
+    for p in xrange(n):
+        # isleft[q,x] is True iff x is on the left of p,q
+        isleft = np.dot(np.cross(xyz[p],xyz),xyz.T) > 0
+        # Rounding must not put p or q on a side of their own great circle
+        isleft[:,p] = False
+        isleft[np.arange(n),np.arange(n)] = False
+
+        left = np.zeros([n,width],dtype=bool)
+        left[:,width-n:] = isleft[:,::-1]
+        packed = np.packbits(left,axis=1)
+        sides.append([ int(binascii.hexlify(row.tostring()),16) for row in packed ])
+
+    return sides
+
+def bitsToList(bits):
+    # The positions of the set bits, in increasing order
+    members = []
+    while bits:
+        low = bits & -bits
+        members.append(low.bit_length()-1)
+        bits ^= low
+    return members
 
 def planeDist(x,y):
-    x = x.reshape([-1,2])
-    y = y.reshape([-1,2])
+    '''
+    d[i,j] is the distance between x[i] and y[j] in the plane
+    '''
+    x = np.asarray(x,dtype=float).reshape([-1,2])
+    y = np.asarray(y,dtype=float).reshape([-1,2])
 
-    return np.sqrt(np.array([ [sum( (a-b)**2 ) for a in y] for b in x ]))
+    dx = np.subtract.outer(x[:,0],y[:,0])
+    dy = np.subtract.outer(x[:,1],y[:,1])
+
+    return np.hypot(dx,dy,out=dx)
 
 def makeLace(n):
     # sequence of perimeter nodes to hit for a lacing-style triangulation
@@ -205,40 +286,61 @@ def between(a,b,pts):
 def getPerim(pts):
     '''
     Returns a list of indices of the points on the "outside" (in the boundary of the convex hull)
+        They go counter-clockwise, starting from a point with the greatest x-coordinate
+    Points in the middle of a side of the hull are kept, since no triangle of the hull would contain them
+    Of several points at the same place only the first is used
+        the others can't be in a plan, so makePlan leaves them out of the portals
    
     This is for planar points (spherical points should be get Gnomonic projection first)
-    '''
-    # Point with the greatest x-coordinate is certainly outside
-    hix = np.argmax(pts[:,0])
-    # Same goes for the point with the least x-coordinate
-    lox = np.argmin(pts[:,0])
 
-    perim = {hix:lox , lox:hix}
-    perimlist = []
-
-    a = hix
-    b = lox
-    
-    aNeverChanged = True
-
-    while a != hix or aNeverChanged:
-        c = between(a,b,pts)
-        if c == None:
-            # there is no perimeter point between a and b
-            # proceed to the next adjacent pair
-            perimlist.append(a)
-            a = b
-            b = perim[b]
-
-            aNeverChanged = False
-        else:
-            # c is on the perimeter after a
-            # we will next look for another point between a,c
-            perim[a] = c
-            perim[c] = b
-            b = c
-
-    return perimlist
+    Uses Andrew's monotone chain, so it takes O(n log n)
+    '''
+    # Points strictly inside the octagon of the points furthest in eight directions can't be on the hull
+    # Throwing them out first leaves few points for the chain when most are inside
+    directions = np.array([[1,0],[1,1],[0,1],[-1,1],[-1,0],[-1,-1],[0,-1],[1,-1]])
+    octagon = np.argmax(np.dot(pts,directions.T),0)
+    inside = np.ones(len(pts),dtype=bool)
+    for i in range(8):
+        a,b = pts[octagon[i-1]],pts[octagon[i]]
+        inside &= (b[0]-a[0])*(pts[:,1]-a[1]) - (b[1]-a[1])*(pts[:,0]-a[0]) > 0
+    candidates = np.flatnonzero(~inside)
+
+    # Sort by x, then y. lexsort is stable, so the first of any duplicates comes first
+    order = candidates[np.lexsort((pts[candidates,1],pts[candidates,0]))]
+    xs = pts[order,0].tolist()
+    ys = pts[order,1].tolist()
+
+    inds = []
+    for i in xrange(len(order)):
+        if len(inds) > 0 and xs[i] == xs[inds[-1]] and ys[i] == ys[inds[-1]]:
+            continue
+        inds.append(i)
+
+    def turnsRight(chain,c):
+        # True iff the last two points of chain and c go clockwise
+        a,b = chain[-2],chain[-1]
+        return (xs[b]-xs[a])*(ys[c]-ys[a]) - (ys[b]-ys[a])*(xs[c]-xs[a]) < 0
+
+    # Going right along the bottom and then left along the top keeps the hull on the left
+    # Only points that turn right are dropped, so the ones in line along a side stay
+    lower = []
+    for c in inds:
+        while len(lower) >= 2 and turnsRight(lower,c):
+            lower.pop()
+        lower.append(c)
+
+    upper = []
+    for c in reversed(inds):
+        while len(upper) >= 2 and turnsRight(upper,c):
+            upper.pop()
+        upper.append(c)
+
+    if len(lower) == len(upper) == len(inds):
+        # Only points all in one line are on both chains
+        return [ order[i] for i in inds[::-1] ]
+
+    # upper starts at the greatest x and each chain ends where the other starts
+    return [ order[i] for i in upper[:-1]+lower[:-1] ]
 
 def arc(a,b,c):
     '''
@@ -309,3 +411,8 @@ if __name__ == '__main__':
     print tb/np.pi
     print tc/np.pi
 
+    # A point in the middle of a side stays on the perimeter, in order, and a repeated one is used once
+    pts = np.array([[0.,0],[2,0],[2,2],[0,2],[1,0],[1,1],[2,2]])
+    perim = getPerim(pts)
+    print perim
+    assert perim == [2,3,0,4,1]
@@ -1,4 +1,6 @@
 
+import time
+import collections
 import geometry
 np = geometry.np
 from Triangle import Triangle,Deadend
@@ -11,123 +13,154 @@ This is the number of times to randomly rebuild each first generation triangle w
 '''
 TRIES_PER_TRI = 10
 
-def canFlip(degrees,keylacks,p,q):
+'''
+A sample gives up after this many failed builds
+Retrying a bad start can otherwise take exponentially long on large portal sets
+'''
+MAX_DEADENDS = 200
+
+def reversibleIn(a):
+    # For each portal, the set of portals with a reversible link into it
+    inrev = [ set() for p in xrange(a.order()) ]
+    for i in xrange(a.size()):
+        if a.reversible[i]:
+            p,q = a.edges[i]
+            inrev[q].add(p)
+    return inrev
+
+def augment(a,inrev,u,isTarget):
     '''
-    True iff reversing edge p,q is a paraeto improvement
-        out-degree of q must be <8
-        p must have a key surplus
+    Looks for a path of reversible links v -> ... -> u from a portal v with isTarget(v)
+    and reverses the whole path if there is one
+        u then needs one key less and gets another outgoing link
+        v needs one key more and has one outgoing link less
+        the portals in between keep their degrees
+
+    Returns True if a path was reversed
     '''
-    return (degrees[q,1] < 8) & (keylacks[p]<0)
-
-def flip(a,p,q,degrees=None,keylacks=None):
-    if not a.edge[p][q]['reversible']:
-        print '!!!! Trying to reverse a non-reversible edge !!!!'
-        print p,q
-    # Give the reversed edge the same properties
-    a.add_edge(q,p,a.edge[p][q])
-    a.remove_edge(p,q)
-    if degrees != None:
-        degrees[p,0] += 1
-        degrees[p,1] -= 1
-        degrees[q,0] -= 1
-        degrees[q,1] += 1
-
-    if keylacks != None:
-        keylacks[p] += 1
-        keylacks[q] -= 1
-
-def flipSome(a):
+    # Breadth first, so the path is as short as possible
+    parent = {u:None}
+    queue = collections.deque([u])
+    while len(queue) > 0:
+        w = queue.popleft()
+        for v in inrev[w]:
+            if v in parent:
+                continue
+            parent[v] = w
+            if isTarget(v):
+                while v != u:
+                    w = parent[v]
+                    a.flip(v,w)
+                    inrev[w].remove(v)
+                    inrev[v].add(w)
+                    v = w
+                return True
+            queue.append(v)
+    return False
+
+def orient(a):
     '''
-    Tries to make each in and out degree of a <=8 by reversing edges
-    Only edges with the property reversible=True will be flipped
+    Orients the reversible links of PlanGraph a to lower TK + 2*MK (see PlanGraph)
+
+    Keys are moved along paths of reversible links with augment
+        First each portal missing MK keys hands one to a portal missing at most MK-2, until one can't
+        Then portals missing keys hand them to portals with spare keys, until none can
+    Neither step raises TK or MK. A path only starts from a portal with fewer than 8 outgoing links
+    Whole paths are reversed, so it does not stop where no single flip helps
     '''
-    n = a.order()
-    degrees  = np.empty([n,2],dtype=int)
-    keylacks = np.empty(n,dtype=int) # negative if there's a surplus
-
-    # column 0 is in-degree, col 1 is out-degree
-    for i in xrange(n):
-        degrees[i,0] = a.in_degree(i)
-        degrees[i,1] = a.out_degree(i)
-        keylacks[i] = degrees[i,0]-a.node[i]['keys']
-
-    # We can never make more than 8 outogoing links. Reducing these is first priority
-#    manyout = (degrees[:,1]>8).nonzero()[0]
-#    for p in manyout:
-#        qs = list(a.edge[p].iterkeys())
-#        for q in qs:
-#            if a.edge[p][q]['reversible'] and canFlip(degrees,keylacks,p,q):
-#                flip(a,p,q,degrees,keylacks)
-#            if degrees[p,1] <= 8:
-#                break
-#        else:
-#            # This runs if the for loop exits without the break
-#            print 'Could not reduce OUT-degree sufficiently for %s'%p
-
-    # It is difficult to gather more keys. Reducing key-gathering is next priority
-    # We'll process the ones with the greatest need first
-    needkeys = (keylacks>0).nonzero()[0]
-    needkeys = needkeys[np.argsort(keylacks[needkeys])][::-1]
-    for q in needkeys:
-        for p,q2 in a.in_edges(q):
-            if a.edge[p][q]['reversible'] and canFlip(degrees,keylacks,p,q):
-                flip(a,p,q,degrees,keylacks)
-            if keylacks[q] <= 0:
+    lack  = a.lacks.lack # negative if there's a surplus
+    inrev = reversibleIn(a)
+
+    lowering = True
+    while lowering and a.lacks.MK > 0:
+        MK = a.lacks.MK
+        for u in (lack == MK).nonzero()[0]:
+            if a.outdeg[u] >= 8 or \
+               not augment(a,inrev,u,lambda v: lack[v] <= MK-2):
+                # MK can't be lowered any more
+                lowering = False
                 break
-#        else:
-            # This runs if the for loop exits without the break
-#            print 'Could not reduce IN-degree sufficiently for %s'%q
 
+    # We'll process the ones with the greatest need first
+    for u in np.argsort(lack)[::-1]:
+        while lack[u] > 0 and a.outdeg[u] < 8 and \
+              augment(a,inrev,u,lambda v: lack[v] < 0):
+            pass
 
 def removeSince(a,m,t):
-    # Remove all but the first m edges from a (and .edge_stck)
+    # Remove all but the first m edges from a
     # Remove all but the first t Triangules from a.triangulation
-    for i in xrange(len(a.edgeStack) - m):
-        p,q = a.edgeStack.pop()
-        a.remove_edge(p,q)
-#        print 'removing',p,q
-#        print a.edgeStack
+    a.undo(m)
     while len(a.triangulation) > t:
         a.triangulation.pop()
 
 
-def triangulate(a,perim):
+def triangulate(a,perim,rng=np.random,deadline=None):
     '''
-    Recursively tries every triangulation in search a feasible one
-        Each layer
+    Tries every triangulation in search a feasible one
+        For each polygon
             makes a Triangle out of three perimeter portals
             for every feasible way of max-fielding that Triangle
                 try triangulating the two perimeter-polygons to the sides of the Triangle
 
+    a is a PlanGraph
+    rng is the random number generator (np.random or a RandomState)
+    deadline is the time.time() at which to give up (default never)
+
+    The polygons being searched are kept on an explicit stack of polygonSearch generators
+    so the search can be stopped between any two steps and needs no recursion
+
     Returns True if a feasible triangulation has been made in graph a
     '''
+    stack = [polygonSearch(a,perim,rng)]
+    result = None
+    while True:
+        if deadline is not None and time.time() > deadline:
+            return False
+
+        step = stack[-1].send(result)
+        if isinstance(step,bool):
+            # The polygon on top of the stack is done
+            stack.pop()
+            if len(stack) == 0:
+                return step
+            result = step
+        else:
+            # It asks for a side polygon to be triangulated
+            stack.append(polygonSearch(a,step,rng))
+            result = None
+
+def polygonSearch(a,perim,rng):
+    '''
+    The search for one polygon in triangulate
+    Yields each side polygon that must be triangulated and is sent back whether it was
+    The last thing it yields is True if this polygon was triangulated, False if not
+    '''
     pn = len(perim)
     if pn < 3:
-        return True
-
-    try:
-        startStackLen = len(a.edgeStack)
-    except AttributeError:
-        startStackLen = 0
-        a.edgeStack = []
-    try:
-        startTriLen = len(a.triangulation)
-    except AttributeError:
-        startTriLen = 0
-        a.triangulation = []
+        yield True
+
+    startStackLen = a.size()
+    startTriLen = len(a.triangulation)
 
     # Try all triangles using perim[0:2] and another perim node
-    for i in np.random.permutation(range(2,pn)):
+    for i in rng.permutation(range(2,pn)):
+        if a.deadends >= MAX_DEADENDS:
+            break
+        # The perimeter keeps portals in the middle of its sides. Three in line make no field
+        if a.inLine(perim[0],perim[1],perim[i]):
+            continue
 
         for j in xrange(TRIES_PER_TRI):
             t0 = Triangle(perim[[0,1,i]],a,True)
             t0.findContents()
-            t0.randSplit()
+            t0.randSplit(rng)
             try:
                 t0.buildGraph()
             except Deadend as d:
                 # remove the links formed since beginning of loop
                 removeSince(a,startStackLen,startTriLen)
+                a.deadends += 1
             else:
                 # This build was successful. Break from the loop
                 break
@@ -135,34 +168,157 @@ def triangulate(a,perim):
             # The loop ended "normally" so this triangle failed
             continue
 
-        if not triangulate(a,perim[range(1,i   +1   )]): # 1 through i
+        if not (yield perim[range(1,i   +1   )]): # 1 through i
             # remove the links formed since beginning of loop
             removeSince(a,startStackLen,startTriLen)
             continue
 
-        if not triangulate(a,perim[range(0,i-pn-1,-1)]): # i through 0
+        if not (yield perim[range(0,i-pn-1,-1)]): # i through 0
            # remove the links formed since beginning of loop
            removeSince(a,startStackLen,startTriLen)
            continue
 
         # This will be a list of the first generation triangles
         a.triangulation.append(t0)
+        # Its links start here
+        t0.mark = startStackLen
 
         # This triangle and the ones to its sides succeeded
-        return True
+        yield True
 
     # Could not find a solution
-    return False
+    yield False
     
-def maxFields(a):
-    n = a.order()
+def splittable(built):
+    # (j,t) for every triangle t with contents under first generation triangle built[j]
+    found = []
+    for j in xrange(len(built)):
+        stack = [built[j]]
+        while len(stack) > 0:
+            t = stack.pop()
+            if len(t.contents) > 0:
+                found.append((j,t))
+            stack.extend(t.children)
+    return found
+
+def improve(a,moves,rng=np.random,deadline=None):
+    '''
+    Local search on a finished plan in PlanGraph a
+    Each move splits one Triangle again and rebuilds the links from its first generation triangle on
+        The links made before that first generation triangle are kept
+    The move is kept if TK + 2*MK (see PlanGraph) gets no worse, otherwise the plan is put back
+    Moves that change the plan without lowering TK + 2*MK are kept so the search can go on from there
+
+    deadline is the time.time() at which to stop (default never)
+        The same plan is only made again by running the same number of moves
 
-    pts = np.array([ a.node[i]['xy'] for i in xrange(n) ])
+    Returns ran,improved,even
+        ran is the number of moves made before the deadline
+        improved is the number of them that lowered TK + 2*MK
+        even is the number kept that left it the same
+    '''
+    # First generation triangles in the order they were built
+    built = sorted(a.triangulation,key=lambda t: t.mark)
+    candidates = splittable(built)
+    if len(candidates) == 0:
+        return 0,0,0
+
+    TK,MK = a.keyLack()
+    bestlack = TK+2*MK
+    improved = 0
+    even = 0
+
+    ran = 0
+    for move in xrange(moves):
+        if deadline is not None and time.time() > deadline:
+            break
+        ran += 1
+
+        j,t = candidates[rng.randint(len(candidates))]
+        state = a.snapshot()
+        verts,children,center = list(t.verts),t.children,t.center
+
+        a.undo(built[j].mark)
+        t.randSplit(rng)
+        try:
+            for t0 in built[j:]:
+                t0.buildGraph()
+        except Deadend as d:
+            weightedlack = np.inf
+        else:
+            orient(a)
+            TK,MK = a.keyLack()
+            weightedlack = TK+2*MK
+
+        if weightedlack <= bestlack:
+            if weightedlack < bestlack:
+                improved += 1
+            else:
+                even += 1
+            bestlack = weightedlack
+            # The old descendants of t are gone
+            candidates = splittable(built)
+        else:
+            a.restore(state)
+            t.verts,t.children,t.center = verts,children,center
+
+    return ran,improved,even
+
+def fillSides(a,perim):
+    '''
+    getPerim finds the perimeter in the plane, where a portal on a side may come out just inside
+    The triangles only contain portals strictly inside them on the sphere, so it would be in none
+    Every portal that isn't strictly inside all the sides is put in the perimeter
+        on the first side it is not inside of, in order along that side
+    '''
+    inside = np.ones(a.order(),dtype=bool)
+    inside[perim] = False
+
+    filled = []
+    for k in xrange(len(perim)):
+        p,q = perim[k],perim[(k+1)%len(perim)]
+        left = a.leftOf(p,q)
+        onside = (inside & ~left).nonzero()[0]
+        inside &= left
+
+        filled.append(p)
+        along = np.sum((a.xy[onside]-a.xy[p])**2,1)
+        filled.extend(onside[np.argsort(along)])
+
+    return np.array(filled)
+
+def maxFields(a,rng=np.random,deadline=None):
+    '''
+    a is a PlanGraph with no links
+    deadline is the time.time() at which to give up (default never)
 
-    perim = np.array(geometry.getPerim(pts))
-    if not triangulate(a,perim):
+    Returns True if a plan has been made in a
+    '''
+    perim = fillSides(a,geometry.getPerim(a.xy))
+    if not triangulate(a,perim,rng,deadline):
         return False
-    flipSome(a)
+    orient(a)
 
     return True
 
+
+if __name__=='__main__':
+    import networkx as nx
+    from PlanGraph import PlanGraph
+
+    # Three portals on the equator and two north of it. Portal 1 is in the middle of a side of the perimeter
+    lls = np.array([[0,-2000],[0,0],[0,2000],[1500,0],[700,300]],dtype=float)
+    locs = geometry.e6LLtoRads(lls)
+    xyz  = geometry.radstoxyz(locs)
+    xy   = geometry.gnomonicProj(locs,xyz)
+
+    a = nx.DiGraph()
+    for i in xrange(len(lls)):
+        a.add_node(i,xy=xy[i],xyz=xyz[i],keys=0)
+
+    for sides in [None,geometry.sideSets(xyz)]:
+        b = PlanGraph(a,sides)
+        print 'perimeter:', fillSides(b,geometry.getPerim(b.xy))
+        assert maxFields(b,np.random.RandomState(0))
+        print 'links:', b.edges[:b.m].tolist()
+        assert (b.outdeg+b.indeg > 0).all()
@@ -4,77 +4,101 @@ np = branch_bound.np
 
 MAX_BRANCHES = 10000
 
+# The searches getVisits can use
+ENGINES = ['beam','bb']
+
 # This could be used if more splits are wanted than are possible
 infState = branch_bound.InfState()
 
-class OTSPstate:
-    def __init__(self,d,order,nagents,visit2agent=[0],time=[0.],lastat=None,):
+# What all the states of a search share. Only the root carries it in its pickle
+SHARED = ['d','order','remaining']
+# What the pickles of the other states carry, as a tuple
+PICKLED = ['nagents','visit2agent','m','lastpos','lasttime','value','agent','frontier','frontierTimes']
+
+class OTSPstate(object):
+    def __init__(self,d,order,nagents,visit2agent=[0]):
         '''
         d: distance matrix
         order: order in which nodes must be visited
-        time: time at which the nodes were visited
-        lastat[i,j]: the node where agent j most recently was at time[i]
         nagents: number of agents
         visit2agent[i] is the agent who makes visit i
+            only used by calcTimes
+
+        A state only knows where each agent is now and the state it came from
+            lastpos[j]:  the node where agent j made his last visit (None if undeployed)
+            lasttime[j]: the time at which he made it
+            value:       the time at which the last visit was made
+            agent:       the agent who made the last visit
+            parent:      the state before the last visit
+            frontier, frontierTimes: the positions and times sorted by sortFrontier
+        The whole schedule is rebuilt from the parents by visits()
+
+        This is the root. Agent 0 makes visit 0
         '''
-        # This is the root
-        if lastat == None:
-            self.n = d.shape[0]
-
-            lastat = [[None]*nagents]
-            lastat[0][0] = 0
-
-            # Make a "start location" that is at distance 0 from everywhere
-            # Using index -1 for undeployed agents puts them at this "start"
-        else:
-            # "start" location has already been added but doesn't count
-            self.n = d.shape[0] - 1
-
         self.d = d
 
-        self.lastat = lastat
-
         self.order = order
         self.nagents = nagents
         self.visit2agent = visit2agent
-        self.time = time
-        self.m = len(time) # numer of visits that have already been made
+        self.m = 1 # numer of visits that have already been made
+
+        # remaining = (byLast,nleft) is shared by all the states
+        # The nodes still to be visited after m visits are byLast[:nleft[m]]
+        # byLast has the nodes from the last visited to the first
+        lastVisit = {}
+        for i in xrange(len(order)):
+            lastVisit[order[i]] = i
+        byLast = sorted(lastVisit,key=lastVisit.get,reverse=True)
+        nleft = np.cumsum(np.bincount([ lastVisit[p] for p in byLast ],minlength=len(order))[::-1])[::-1]
+        self.remaining = (np.array(byLast,dtype=int),nleft)
+
+        self.lastpos  = [order[0]]+[None]*(nagents-1)
+        self.lasttime = [0.]*nagents
+        self.value  = 0.
+        self.agent  = 0
+        self.parent = None
+        self.sortFrontier()
 
-        self.value = self.time[-1]
+        self.children = []
 
     def agentsNewTime(self,agent):
         # The time at which this agent could make the next visit
         
-        # The index of the last visit this agent made
-        lastvisit = self.lastat[-1][agent]
-
-#        print len(self.time)
-#        print self.d.shape
-#        print 'agent',agent
-#        print '  lastvisit',lastvisit
+        # The node at which agent made his last visit
+        lastpos = self.lastpos[agent]
 
         # Assume agent's initial deployment is instantaneous
-        if lastvisit == None:
-            return self.time[-1]
+        if lastpos == None:
+            return self.value
 
-        # The node at which agent made his last visit
-        lastpos   = self.order[lastvisit]
-        # The time at which agent was at lastpos
-        lasttime  = self.time[lastvisit]
         # The node that needs to be visited next
         nextpos = self.order[self.m]
 
-#        print '  lastat',self.lastat
-#        print '  lastpos',lastpos
-#        print '  lasttime',lasttime
-#        print '  nextpos',nextpos
-
-        t = max( self.time[-1] , lasttime + self.d[nextpos,lastpos] )
-#        print '  t',t
-        return t
-
         # He makes it either at the same time as the previous visit or as soon as he arrives at nextpos
-        return max( self.time[-1] , lasttime + self.d[nextpos,lastpos] )
+        arrival = self.lasttime[agent] + float(self.d[nextpos,lastpos])
+        if arrival < self.value:
+            return self.value
+        return arrival
+
+    def child(self,agent):
+        # The state after agent makes the next visit
+        # Same as copy.copy, which would go through __getstate__
+        child = OTSPstate.__new__(OTSPstate)
+        child.__dict__.update(self.__dict__)
+        child.parent = self
+        child.agent  = agent
+        child.m      = self.m+1
+        child.value  = self.agentsNewTime(agent)
+        child.children = []
+
+        # Everyone's last known position is the same, except that agent is now at the next node
+        child.lastpos  = list(self.lastpos)
+        child.lasttime = list(self.lasttime)
+        child.lastpos [agent] = self.order[self.m]
+        child.lasttime[agent] = child.value
+        child.sortFrontier()
+
+        return child
 
     def split(self,num):
         '''
@@ -86,74 +110,206 @@ class OTSPstate:
         if self.m >= len(self.order):
             raise branch_bound.CantSplit()
 
-        self.children = []
-        for agent in range(self.nagents):
-            newtime = self.agentsNewTime(agent)
-            
-            # Everyone's last known position is the same, except that agent is now at m
-            newlast = list(self.lastat[-1])
-            newlast[agent] = self.m
-
-            self.children.append(OTSPstate(self.d,self.order,self.nagents,\
-                                 self.visit2agent+[agent],\
-                                 self.time+[newtime],\
-                                 self.lastat+[newlast],\
-                                ))
-        if num < self.nagents:
+        # Undeployed agents are interchangeable. Only the first of them needs to be tried
+        agents = [ agent for agent in range(self.nagents) if self.lastpos[agent] != None ]
+        if len(agents) < self.nagents:
+            agents.append(self.lastpos.index(None))
+
+        self.children = [ self.child(agent) for agent in agents ]
+
+        if num < len(self.children):
             childorder = np.argsort([ child.value for child in self.children ])
             self.children = np.array(self.children)
             self.children = self.children[childorder[:num]]
 
+    def sortFrontier(self):
+        # Sorting the agents by (position,time) matches them up for dominates()
+        frontier = sorted(zip(self.lastpos,self.lasttime))
+        self.frontier      = tuple( pos for pos,t in frontier )
+        self.frontierTimes = [ t for pos,t in frontier ]
+
+    def key(self):
+        # The nodes where the agents are, whoever they are. States with the same key differ only in times
+        return self.frontier
+
+    def dominates(self,other):
+        '''
+        True if other can't finish any earlier than this state
+            other has the same key, so the agents can be matched by position
+            each of this state's agents must have been there no later than his match
+        '''
+        if self.value > other.value:
+            return False
+        for t,othert in zip(self.frontierTimes,other.frontierTimes):
+            if t > othert:
+                return False
+        return True
+
+    def bound(self):
+        '''
+        A lower bound on the time of the last visit made from this state
+            Every node left to visit must be reached by an agent from where he is now
+        An undeployed agent could start anywhere, so then there is no better bound than self.value
+        '''
+        if None in self.lastpos or self.m >= len(self.order):
+            return self.value
+
+        byLast,nleft = self.remaining
+        nodes = byLast[:nleft[self.m]]
+        arrivals = self.d.take(self.lastpos,1).take(nodes,0) + self.lasttime
+
+        return max( self.value , arrivals.min(1).max() )
+
+    def __getstate__(self):
+        # Pickles for the branch_bound workers leave out what all the states share
+        # The root keeps it, since the workers get it from the root
+        # The shared data and the parent are put back by share and adopt
+        # The children are made again in the worker, and sent back on their own
+        if self.parent is None:
+            names = PICKLED+SHARED
+        else:
+            names = PICKLED
+        return tuple( self.__dict__[name] for name in names )
+
+    def __setstate__(self,state):
+        self.__dict__.update(zip(PICKLED+SHARED,state))
+        self.parent = None
+        self.children = []
+
+    def share(self,other):
+        # Take what all the states share from other
+        for name in SHARED:
+            setattr(self,name,getattr(other,name))
+
+    def adopt(self,children):
+        # Link up children that were made in a worker process
+        for child in children:
+            child.share(self)
+            child.parent = self
+
+    def visits(self):
+        '''
+        returns visit2agent,time for the visits made up to this state
+            visit2agent[i] is the agent who makes visit i
+            time[i] is the time at which visit i is made
+        '''
+        visit2agent = []
+        time = []
+        state = self
+        while state != None:
+            visit2agent.append(state.agent)
+            time.append(state.value)
+            state = state.parent
+
+        return visit2agent[::-1],time[::-1]
+
     def calcTimes(self):
         '''
-        Calculates self.time and self.lastat
+        Calculates self.time
             Uses data from self.d and self.visit2agent
         Assumes self.time[0] should be 0
-        self.time and self.lastat are overwritten
+        self.time is overwritten
         '''
-        nvisits = len(self.order)
+        state = OTSPstate(self.d,self.order,self.nagents)
+        for i in xrange(1,len(self.order)):
+            state = state.child(self.visit2agent[i])
 
-        # These could be pre-allocated if agentsNewTime didn't use negativ index
+        visit2agent,self.time = state.visits()
+        self.value = self.time[-1]
+        return self.value
 
-        # Same initialization as in __init__
-        self.time        = [0.]
-        self.m           = 1
-        # Agent 0 makes visit 0
-        self.lastat = [ [0]+[None]*(self.nagents-1) ]
 
-        for i in xrange(1,nvisits):
-            agent = self.visit2agent[i]
+def beamVisits(dists,order,nagents,width):
+    '''
+    Beam search for getVisits with every state of the beam held in arrays
+        lastpos[s,j]  the node where agent j of state s made his last visit (-1 if undeployed)
+        lasttime[s,j] the time of that visit
+        now[s]        the time of the last visit made in state s
+    Every state is expanded by every agent and the width best children are kept
+    parents[i][s] and agents[i][s] tell which state and agent child s came from at visit i
+        so the schedule is only put together for the winner
+
+    Undeployed agents are interchangeable, so only the first of them is tried
+    '''
+    nvisits = len(order)
 
-            t = self.agentsNewTime(agent)
+    # Agent 0 makes visit 0
+    lastpos  = np.full([1,nagents],-1,dtype=int)
+    lasttime = np.zeros([1,nagents])
+    lastpos[0,0] = order[0]
+    now = np.zeros(1)
 
-            self.time.append(t)
-            self.m += 1
+    parents = [None]*nvisits
+    agents  = [None]*nvisits
+    times   = [now]
 
-            # Everyone has same position except for agent
-            self.lastat.append(list(self.lastat[-1]))
-            self.lastat[-1][agent] = i
-            
-        self.children = []
-        self.value = self.time[-1]
-        return self.value
+    agentInds = np.arange(nagents)
+    for i in xrange(1,nvisits):
+        nextpos = order[i]
+
+        # He makes it either at the same time as the previous visit or as soon as he arrives at nextpos
+        deployed = lastpos >= 0
+        arrive = lasttime + dists[nextpos,lastpos]
+        newtime = np.where(deployed,np.maximum(arrive,now[:,None]),now[:,None])
 
+        # Only the first undeployed agent of each state
+        firstfree = np.argmin(deployed,1)
+        newtime[~deployed & (agentInds != firstfree[:,None])] = np.inf
 
-def getVisits(dists,order,nagents):
+        newtime = newtime.ravel()
+        if len(newtime) > width:
+            keep = np.argpartition(newtime,width-1)[:width]
+        else:
+            keep = np.arange(len(newtime))
+        keep = keep[np.isfinite(newtime[keep])]
+
+        parent = keep // nagents
+        agent  = keep %  nagents
+        now = newtime[keep]
+
+        lastpos  = lastpos [parent]
+        lasttime = lasttime[parent]
+        lastpos [np.arange(len(keep)),agent] = nextpos
+        lasttime[np.arange(len(keep)),agent] = now
+
+        parents[i] = parent
+        agents [i] = agent
+        times.append(now)
+
+    # Trace the best state back to the root
+    s = np.argmin(now)
+    visit2agent = [0]*nvisits
+    time        = [0.]*nvisits
+    for i in xrange(nvisits-1,0,-1):
+        visit2agent[i] = int(agents[i][s])
+        time[i]        = float(times[i][s])
+        s = parents[i][s]
+
+    return visit2agent,time
+
+def getVisits(dists,order,nagents,engine='beam',workers=1):
     '''
     dists:   a distance matrix
     order:   the order in which nodes must be visited
              duplicates allowed
     nagents: the number of agents available to make the visits
+    engine:  'beam' for the array beam search in beamVisits
+             'bb' for the OTSPstate search with branch_bound
+    workers: number of processes splitting the states with engine 'bb'
              
     returns visits,time
               visits[i] = j means the ith visit should be performed by agent j
               time[i] is the number of meters a person could have walked walk since the start when visit i is made 
     '''
-    root = OTSPstate(dists,order,nagents)
     LO = MAX_BRANCHES // nagents
-    state, value = branch_bound.branch_bound(root, LO, LO*nagents)
 
-    return state.visit2agent,state.time
+    if engine == 'beam':
+        return beamVisits(dists,order,nagents,LO)
+
+    root = OTSPstate(dists,order,nagents)
+    state, value = branch_bound.branch_bound(root, LO, LO*nagents, workers)
+
+    return state.visits()
 
 if __name__=='__main__':
     import geometry
@@ -181,3 +337,7 @@ if __name__=='__main__':
     state = OTSPstate(d,order,2,visit2agent)
     print state.calcTimes()
 
+    # The nodes left to visit after each number of visits
+    byLast,nleft = state.remaining
+    for m in xrange(len(order)):
+        assert set(byLast[:nleft[m]]) == set(order[m:])
@@ -0,0 +1,189 @@
+
+import json
+import codecs
+import numpy as np
+from xml.sax.saxutils import escape
+
+# The formats a plan can be exported in
+FORMATS = ['geojson','drawtools','svg']
+# The file each format is written to
+FILENAMES = {'geojson':'plan.geojson', 'drawtools':'plan_drawtools.json', 'svg':'plan.svg'}
+
+# The larger side of the svg image in pixels, and the space around the portals
+SVG_SIZE   = 800
+SVG_MARGIN = 30
+
+# Opacity of the fields in the svg image
+FIELD_OPACITY = 0.3
+
+class PlanExport:
+    '''
+    The plan a as vector data for web maps and IITC, made without drawing anything
+        portals are numbered north to south, as on the maps and in the key lists
+        links are numbered in the order they are made, with the fields each one completes
+    movements[i] lists the links agent i makes, as in PlanPrinter
+        without it the links are not assigned to agents
+    '''
+    def __init__(self,a,movements=None,color='#FF004D'):
+        self.a = a
+        self.n = a.order()
+        self.m = a.size()
+        self.color = color
+
+        # if the ith link to be made is (p,q) then orderedEdges[i] = (p,q)
+        self.orderedEdges = [None] * self.m
+        for p,q in a.edges_iter():
+            self.orderedEdges[a.edge[p][q]['order']] = (p,q)
+
+        # Latitude and longitude of each portal in degrees
+        self.latlon = np.degrees([a.node[i]['geo'] for i in xrange(self.n)])
+        self.xy = np.array([a.node[i]['xy'] for i in xrange(self.n)])
+
+        # The same numbering as PlanPrinter.nslabel
+        posOrder = np.argsort(self.xy,axis=0)[::-1,1]
+        self.nslabel = [-1]*self.n
+        for i in xrange(self.n):
+            self.nslabel[posOrder[i]] = i
+
+        self.link2agent = [None] * self.m
+        if movements is not None:
+            for agent in xrange(len(movements)):
+                for e in movements[agent] or []:
+                    self.link2agent[e] = agent
+
+    def lonlat(self,p):
+        # GeoJSON puts longitude first. The portals come from E6 coordinates
+        return [ round(self.latlon[p,1],6) , round(self.latlon[p,0],6) ]
+
+    def latLng(self,p):
+        return {'lat':round(self.latlon[p,0],6), 'lng':round(self.latlon[p,1],6)}
+
+    def ring(self,field):
+        # The closed, counterclockwise outline of a field, as GeoJSON wants polygons
+        pts = [ self.lonlat(p) for p in field ]
+        (x0,y0),(x1,y1),(x2,y2) = pts
+        if (x1-x0)*(y2-y0) < (x2-x0)*(y1-y0):
+            pts = pts[::-1]
+        return pts + [pts[0]]
+
+    def geoJSON(self):
+        '''
+        A FeatureCollection of the portals, then each link followed by the fields it completes
+            every feature has a 'kind' property: 'portal', 'link' or 'field'
+        '''
+        features = []
+        for p in xrange(self.n):
+            features.append({'type':'Feature',
+                             'geometry':{'type':'Point','coordinates':self.lonlat(p)},
+                             'properties':{'kind':'portal',
+                                           'number':self.nslabel[p],
+                                           'name':self.a.node[p]['name'],
+                                           'keys':self.a.in_degree(p)}})
+
+        for i in xrange(self.m):
+            p,q = self.orderedEdges[i]
+            fields = self.a.edge[p][q]['fields']
+            properties = {'kind':'link',
+                          'order':i,
+                          'origin':self.nslabel[p],
+                          'destination':self.nslabel[q],
+                          'fields':len(fields)}
+            if self.link2agent[i] is not None:
+                properties['agent'] = self.link2agent[i]+1
+            features.append({'type':'Feature',
+                             'geometry':{'type':'LineString','coordinates':[self.lonlat(p),self.lonlat(q)]},
+                             'properties':properties})
+
+            for field in fields:
+                features.append({'type':'Feature',
+                                 'geometry':{'type':'Polygon','coordinates':[self.ring(field)]},
+                                 'properties':{'kind':'field',
+                                               'link':i,
+                                               'portals':[ self.nslabel[r] for r in field ]}})
+
+        return {'type':'FeatureCollection','features':features}
+
+    def drawTools(self):
+        '''
+        The plan as IITC draw-tools items, ready to paste into its import dialog
+            the fields come first so the links and portals are drawn over them
+            draw-tools has no labels, so the items are in the order the links are made
+        '''
+        items = []
+        for i in xrange(self.m):
+            p,q = self.orderedEdges[i]
+            for field in self.a.edge[p][q]['fields']:
+                items.append({'type':'polygon',
+                              'latLngs':[ self.latLng(r) for r in field ],
+                              'color':self.color})
+        for p,q in self.orderedEdges:
+            items.append({'type':'polyline',
+                          'latLngs':[self.latLng(p),self.latLng(q)],
+                          'color':self.color})
+        for p in xrange(self.n):
+            items.append({'type':'marker',
+                          'latLng':self.latLng(p),
+                          'color':self.color})
+        return items
+
+    def svg(self):
+        '''
+        The link map as an svg image, in the projection of the png maps
+            portals and links are labeled with their numbers, and show their names on hover
+        '''
+        lo = self.xy.min(0)
+        span = self.xy.max(0) - lo
+        scale = (SVG_SIZE-2*SVG_MARGIN) / max(span.max(),1e-12)
+        width,height = span*scale + 2*SVG_MARGIN
+
+        # North is up, so y is flipped
+        px = SVG_MARGIN + (self.xy[:,0]-lo[0])*scale
+        py = height - SVG_MARGIN - (self.xy[:,1]-lo[1])*scale
+        point = lambda p: '{0:.1f},{1:.1f}'.format(px[p],py[p])
+
+        lines = [u'<?xml version="1.0" encoding="UTF-8"?>',
+                 u'<svg xmlns="http://www.w3.org/2000/svg" width="{0:.0f}" height="{1:.0f}" font-family="sans-serif" text-anchor="middle">'.format(width,height),
+                 u'<g fill="{0}" fill-opacity="{1}" stroke="none">'.format(self.color,FIELD_OPACITY)]
+        for i in xrange(self.m):
+            p,q = self.orderedEdges[i]
+            for field in self.a.edge[p][q]['fields']:
+                lines.append(u'<polygon points="{0}"/>'.format(' '.join([ point(r) for r in field ])))
+        lines.append(u'</g>')
+
+        lines.append(u'<g stroke="{0}" stroke-width="2">'.format(self.color))
+        for i in xrange(self.m):
+            p,q = self.orderedEdges[i]
+            lines.append(u'<line x1="{0:.1f}" y1="{1:.1f}" x2="{2:.1f}" y2="{3:.1f}"><title>{4}: {5} to {6}</title></line>'.format(\
+                            px[p],py[p],px[q],py[q],i,self.nslabel[p],self.nslabel[q]))
+        lines.append(u'</g>')
+
+        # Link numbers halfway along the links, as on linkMap.png
+        lines.append(u'<g font-size="9" dominant-baseline="central">')
+        for i in xrange(self.m):
+            p,q = self.orderedEdges[i]
+            lines.append(u'<text x="{0:.1f}" y="{1:.1f}">{2}</text>'.format(\
+                            (px[p]+px[q])/2,(py[p]+py[q])/2,i))
+        lines.append(u'</g>')
+
+        lines.append(u'<g font-size="10" font-weight="bold" dominant-baseline="central">')
+        for p in xrange(self.n):
+            lines.append(u'<g><title>{0}</title><circle cx="{1:.1f}" cy="{2:.1f}" r="8" fill="{3}"/><text x="{1:.1f}" y="{2:.1f}">{4}</text></g>'.format(\
+                            escape(self.a.node[p]['name']),px[p],py[p],self.color,self.nslabel[p]))
+        lines.append(u'</g>')
+        lines.append(u'</svg>')
+
+        return u'\n'.join(lines)+u'\n'
+
+    def write(self,filename,format):
+        # format is one of FORMATS
+        if format == 'svg':
+            with codecs.open(filename,'w',encoding='utf-8') as fout:
+                fout.write(self.svg())
+            return
+
+        if format == 'geojson':
+            data = self.geoJSON()
+        else:
+            data = self.drawTools()
+        with open(filename,'w') as fout:
+            json.dump(data,fout)
@@ -0,0 +1,254 @@
+
+import time
+import itertools
+import collections
+import multiprocessing
+
+import maxfield
+from PlanGraph import PlanGraph
+np = maxfield.np
+
+def keyLack(b):
+    '''
+    Returns TK,MK for the plan in networkx graph b, as PlanGraph.keyLack does
+    '''
+    TK = 0
+    MK = 0
+    for j in xrange(b.order()):
+        keylack = max(b.in_degree(j)-b.node[j]['keys'],0)
+        TK += keylack
+        if keylack > MK:
+            MK = keylack
+    return TK,MK
+
+def newSeed():
+    # A seed for runs where the user did not pick one
+    return np.random.randint(2**31-1)
+
+def sampleRNG(seed,k):
+    '''
+    The random number generator for sample k of a run with the given seed
+    Every sample gets its own stream so that any one of them can be rebuilt alone
+    '''
+    return np.random.RandomState([seed,k])
+
+# The part of the time left that sampling leaves for local search, when both are asked for
+IMPROVE_SHARE = 0.25
+
+def pastDeadline(deadline):
+    return deadline is not None and time.time() > deadline
+
+def sample(base,seed,k,deadline=None):
+    '''
+    Makes random plan number k of the given seed
+    base is a PlanGraph of the portals
+    deadline is the time.time() at which to give up (default never)
+    Returns None on randomization failure, otherwise TK,MK,b
+        b is the plan (a PlanGraph)
+        b.sampleSeed is (seed,k)
+    '''
+    b = base.copy()
+    if not maxfield.maxFields(b,sampleRNG(seed,k),deadline):
+        return None
+    b.sampleSeed = (seed,k)
+    b.improveMoves = 0
+
+    TK,MK = b.keyLack()
+    return TK,MK,b
+
+# Set in each worker process by initWorker
+_base     = None
+_seed     = None
+_deadline = None
+
+def initWorker(base,seed,deadline=None):
+    global _base,_seed,_deadline
+    _base     = base
+    _seed     = seed
+    _deadline = deadline
+
+def workerSample(k):
+    '''
+    Returns TK,MK for sample k (or None, as sample does)
+    Plans are not sent back. The parent makes the chosen one again from its sample number
+    '''
+    result = sample(_base,_seed,k,_deadline)
+    if result is None:
+        return None
+    TK,MK,b = result
+    return TK,MK
+
+# The best plan made by serialSamples
+_plan = None
+
+def serialSamples(base,seed,deadline=None):
+    # The samples are run in this process, so the best plan is kept instead of being made again
+    global _plan
+    _plan = None
+    bestlack = np.inf
+    for k in itertools.count():
+        result = sample(base,seed,k,deadline)
+        if result is None:
+            yield None
+            continue
+
+        TK,MK,b = result
+        if TK+2*MK < bestlack:
+            bestlack = TK+2*MK
+            _plan = b
+        yield TK,MK
+
+def poolSamples(base,seed,workers,deadline=None):
+    '''
+    Yields the results of samples run by a pool of worker processes
+    Results come in the order of the sample numbers
+    A couple of samples per worker are kept in flight so no worker waits on the parent
+    '''
+    pool = multiprocessing.Pool(workers,initWorker,(base,seed,deadline))
+    try:
+        k = itertools.count()
+        pending = collections.deque([ pool.apply_async(workerSample,(k.next(),))\
+                                      for i in xrange(2*workers) ])
+        while True:
+            result = pending.popleft().get()
+            pending.append(pool.apply_async(workerSample,(k.next(),)))
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def improve(b,moves,deadline=None):
+    '''
+    Local search on plan b from sample with the given number of moves (see maxfield.improve)
+    The moves are random but fixed by b.sampleSeed, so replay can repeat them
+        b.improveMoves is set to the number of moves made before the deadline
+        replaying that many moves rebuilds the same plan
+    '''
+    seed,k = b.sampleSeed
+    ran,improved,even = maxfield.improve(b,moves,np.random.RandomState([seed,k,1]),deadline)
+    b.improveMoves = ran
+
+    TK,MK = b.keyLack()
+    if ran < moves:
+        print 'Local search stopped after {} of {} moves'.format(ran, moves)
+    print 'Local search improved the plan {} times in {} moves ({} more changed it without improving):\ttotal: {}\tmax: {}\tweighted: {}'.format(improved, ran, even, TK, MK, TK+2*MK)
+
+def plan(b,a):
+    # The finished networkx graph for plan b of the portals in a
+    g = b.toDiGraph(a)
+    g.sampleSeed = b.sampleSeed
+    g.improveMoves = b.improveMoves
+    return g
+
+def replay(a,seed,k,sides=None,moves=0):
+    '''
+    Rebuilds sample k of the given seed for the portals in networkx graph a
+    sides is the containment index from geometry.sideSets (optional)
+    moves is the number of local search moves the plan was improved with
+    Returns None on randomization failure, otherwise TK,MK,b
+        b is the plan in a copy of a
+    '''
+    result = sample(PlanGraph(a,sides),seed,k)
+    if result is None:
+        return None
+    TK,MK,b = result
+    if moves > 0:
+        improve(b,moves)
+        TK,MK = b.keyLack()
+    return TK,MK,plan(b,a)
+
+def optimize(a,extraSamples,seed,workers=1,sides=None,deadline=None,moves=0):
+    '''
+    Samples random plans for the portals in networkx graph a until extraSamples samples in a row bring no improvement
+    or until the time.time() passes deadline (default never)
+    Tries to minimize TK + 2*MK (see PlanGraph)
+
+    Sample k uses the random stream sampleRNG(seed,k)
+    workers > 1 spreads the samples over that many processes
+    sides is the containment index from geometry.sideSets (optional)
+    moves is the number of local search moves to improve the best plan with afterwards
+        with a deadline, sampling stops early enough to leave IMPROVE_SHARE of the time for them
+
+    returns bestgraph,allTK,allMK,allWeights
+        bestgraph is the best plan in a copy of a, or None if no sample succeeded
+    '''
+    base = PlanGraph(a,sides)
+
+    sampleDeadline = deadline
+    if moves > 0 and deadline is not None:
+        sampleDeadline = deadline - IMPROVE_SHARE*max(deadline-time.time(),0)
+
+    # The sample number of the best plan
+    bestk = None
+    bestlack = np.inf
+
+    allTK = []
+    allMK = []
+    allWeights = []
+
+    sinceImprove = 0
+
+    if workers > 1:
+        results = poolSamples(base,seed,workers,sampleDeadline)
+    else:
+        results = serialSamples(base,seed,sampleDeadline)
+
+    for k,result in enumerate(results):
+        sinceImprove += 1
+
+        if result is None and pastDeadline(sampleDeadline):
+            # This sample was cut off
+            print 'Time limit reached'
+            break
+
+        if result is None:
+            print 'Randomization failure\n\tThe program may work if you try again. It is more likely to work if you remove some portals.'
+            if sinceImprove >= extraSamples:
+                break
+            continue
+
+        TK,MK = result
+        weightedlack = TK+2*MK
+
+        allTK.append(TK)
+        allMK.append(MK)
+        allWeights.append(weightedlack)
+
+        if weightedlack < bestlack:
+            sinceImprove = 0
+            print 'IMPROVEMENT:\ttotal: {}\tmax: {}\tweighted: {}\t{} tries since improvement'.format(TK, MK, weightedlack, sinceImprove)
+            bestk = k
+            bestlack = weightedlack
+        else:
+            print 'this time:\ttotal: {}\tmax: {}\tweighted: {}\t{} tries since improvement'.format(TK, MK, weightedlack, sinceImprove)
+
+        if bestlack <= 0:
+            print 'KEY PERFECTION'
+            break
+
+        if sinceImprove >= extraSamples:
+            break
+
+        if pastDeadline(sampleDeadline):
+            print 'Time limit reached'
+            break
+
+    results.close()
+
+    if bestk is None:
+        return None,allTK,allMK,allWeights
+
+    if _plan is not None and _plan.sampleSeed == (seed,bestk):
+        # It was made in this process by serialSamples
+        bestgraph = _plan
+    else:
+        # Samples are fixed by their number, so the worker's plan is made again
+        TK,MK,bestgraph = sample(base,seed,bestk)
+
+    if moves > 0:
+        if pastDeadline(deadline):
+            print 'No time left for local search'
+        else:
+            improve(bestgraph,moves,deadline)
+
+    return plan(bestgraph,a),allTK,allMK,allWeights
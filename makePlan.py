@@ -2,7 +2,7 @@
 
 """
 Usage:
-  makePlan.py [-g] [-n <agent_count>] [-s <extra_samples>] <input_file>
+  makePlan.py [-g] [-n <agent_count>] [-s <extra_samples>] [-j <workers>] [--time-limit <seconds>] [--improve <moves>] [--target <minutes>] [--schedule <engine>] [--no-basemap | --tiles <path>] [--animation <format>] [--export <formats>] [--no-images] [--seed <seed> [--sample <sample>]] <input_file>
   makePlan.py -h | --help
 
 Description:
@@ -20,14 +20,69 @@ Description:
 
           this can be used to make the same plan with a different number of agents
 
+  The seed and sample number of the chosen plan are printed and stored in the
+  .pkl output. Running again with --seed and --sample rebuilds that plan
+  without repeating the optimization.
+
+  With --time-limit the optimization stops when the time is up and the best
+  plan found so far is used. Give a large -s to use all of the time. If
+  there is local search too (see --improve), sampling stops with a quarter
+  of the time left for it.
+
+  With --improve the best sample is improved by re-splitting one of its
+  triangles at a time and keeping the changes that need no more keys. The
+  number of moves to give with --seed and --sample to rebuild the improved
+  plan is printed and stored in the .pkl output as improveMoves. It is
+  fewer than asked for if the time limit runs out first.
+
+  A range of agent counts like -n 2..10 schedules the plan for each of them
+  and writes a table of the times to agentSweep.txt. The smallest team that
+  finishes within --target minutes (or the fastest one) is used for the rest
+  of the output.
+
+  The order in which the agents make the links is found with a beam search.
+  With --schedule bb a branch and bound search is used instead. It drops
+  the partial schedules that another one beats and those that can't finish
+  sooner than the first complete one. It is slower, but can find faster
+  schedules for large teams. For a single agent count, -j also splits its
+  work among that many processes, up to the number of cores.
+
+  The maps with backgrounds come from Google, and each image is kept in
+  ~/.maxfield/maps so the same plan never fetches it again. With --tiles
+  they are put together from web mercator tiles in an .mbtiles file or a
+  <zoom>/<x>/<y>.png directory instead. If no background can be had the
+  maps are made without one.
+
+  The step-by-step images are one PNG file each. With --animation they are
+  written as the frames of a single gif or apng file instead.
+
+  With --export the plan is also written as vector data without drawing
+  anything: any of geojson (plan.geojson), drawtools (plan_drawtools.json,
+  for the IITC draw-tools plugin) and svg (plan.svg), separated by commas.
+  Add --no-images to skip the png maps and step-by-step images, which take
+  most of the time.
+
 Options:
   -h --help         Show this screen.
   -g                Make maps hideous instead of blue
-  -n agents         Number of agents [default: 1]
+  -n agents         Number of agents, or a range like 2..10 [default: 1]
   -s extra_samples  Number of iterations to run optimization [default: 100]
+  -j workers        Number of processes taking samples, scheduling and drawing [default: 1]
+  --time-limit seconds  Stop optimizing after this many seconds
+  --improve moves   Local search moves on the best sample [default: 0]
+  --target minutes  How long the operation should take with a range of agents
+  --schedule engine  Search for the agents' link order, beam or bb [default: beam]
+  --no-basemap      Don't make the maps with backgrounds
+  --tiles path      Map tiles for the backgrounds, instead of Google
+  --animation format  Write the step-by-step images as one gif or apng file
+  --export formats  Also write the plan as geojson, drawtools and/or svg
+  --no-images       Don't draw the maps and step-by-step images
+  --seed seed       Seed for the random plan samples (random if omitted)
+  --sample sample   Only build this sample of the given seed
 """
 
 import os
+import time
 import errno
 import docopt
 import pickle
@@ -39,7 +94,7 @@ import networkx as nx
 import matplotlib.pyplot as plt
 
 from ftfy import guess_bytes
-from lib import maxfield, PlanPrinterMap, geometry, agentOrder
+from lib import PlanPrinterMap, geometry, agentOrder, orderedTSP, sampling, basemap, animation, planExport
 from lib.PlanPrinterMap import GREEN, BLUE
 
 def debug(x): # halfassed debugging thing. remove in final version
@@ -54,19 +109,76 @@ def main():
     COLOR = GREEN if args['-g'] else BLUE
 
 
-    nagents = int(args['-n'])
-    if nagents <= 0:
+    if '..' in args['-n']:
+        lo,hi = args['-n'].split('..')
+        agentCounts = range(int(lo),int(hi)+1)
+        if len(agentCounts) == 0:
+            print 'Range of agents should go from the fewest to the most, like 2..10'
+            exit()
+    else:
+        agentCounts = [int(args['-n'])]
+    if agentCounts[0] <= 0:
         print 'Number of agents should be positive'
         exit()
+    nagents = agentCounts[0]
+
+    if args['--target'] is None:
+        target = None
+    else:
+        target = float(args['--target'])*60
+        if target <= 0:
+            print 'Target time should be positive'
+            exit()
+        if len(agentCounts) == 1:
+            print 'Target time needs a range of agents to choose from, like -n 2..10'
+            exit()
 
 
+    engine = args['--schedule']
+    if engine not in orderedTSP.ENGINES:
+        print 'Schedule search should be one of {}'.format(', '.join(orderedTSP.ENGINES))
+        exit()
+
     # We will take many samples in an attempt to reduce number of keys to farm
     # This is the number of samples to take since the last improvement
     EXTRA_SAMPLES = int(args['-s'])
-    if EXTRA_SAMPLES not in range(1, 101):
-        print 'Number of extra samples must be between 1 and 100'
+    if EXTRA_SAMPLES <= 0:
+        print 'Number of extra samples should be positive'
         exit()
 
+    workers = int(args['-j'])
+    if workers <= 0:
+        print 'Number of workers should be positive'
+        exit()
+
+    if args['--time-limit'] is None:
+        deadline = None
+    else:
+        timeLimit = float(args['--time-limit'])
+        if timeLimit <= 0:
+            print 'Time limit should be positive'
+            exit()
+        deadline = time.time() + timeLimit
+
+    moves = int(args['--improve'])
+    if moves < 0:
+        print 'Number of local search moves should not be negative'
+        exit()
+
+    animationFormat = args['--animation']
+    if animationFormat is not None and animationFormat not in animation.FORMATS:
+        print 'Animation format should be one of {}'.format(', '.join(animation.FORMATS))
+        exit()
+
+    if args['--export'] is None:
+        exportFormats = []
+    else:
+        exportFormats = args['--export'].split(',')
+        for fmt in exportFormats:
+            if fmt not in planExport.FORMATS:
+                print 'Export formats should be among {}'.format(', '.join(planExport.FORMATS))
+                exit()
+
 
     input_file = args['<input_file>']
     name, ext = os.path.splitext(os.path.basename(input_file))
@@ -86,14 +198,14 @@ def main():
 
         locs = []
 
+        # The portal at each location. A second portal in the same place can't be linked
+        places = {}
+
         # each line should be name,intel_link,keys
         with open(input_file) as fin:
             text, encoding = guess_bytes(fin.read())
             rows = unicodecsv.reader(text.encode('utf-8').strip().split('\n'), encoding='utf-8')
-            for i, row in enumerate(rows):
-                a.add_node(i)
-                a.node[i]['name'] = row[0]
-
+            for row in rows:
                 url = ','.join(row[1:4]).strip()
                 if not url.startswith('http'):
                     print 'Unable to parse input file. Did you forget to put quotes around a name containing a comma?'
@@ -103,6 +215,14 @@ def main():
                 coord_parts = coords.split(',')
                 lat = int(float(coord_parts[0]) * 1.e6)
                 lon = int(float(coord_parts[1]) * 1.e6)
+                if (lat,lon) in places:
+                    print u'Leaving out {0}: it is in the same place as {1}'.format(row[0], places[lat,lon]).encode('utf-8')
+                    continue
+                places[lat,lon] = row[0]
+
+                i = len(locs)
+                a.add_node(i)
+                a.node[i]['name'] = row[0]
                 locs.append(np.array([lat, lon], dtype=int)) # why does this have to be a numpy array?
                 
                 if '.' in row[-1]:
@@ -111,9 +231,6 @@ def main():
                     a.node[i]['keys'] = int(row[-1])
 
         n = a.order() # number of nodes
-        if n > 65:
-            print 'Limit of 65 portals may be optimized at once'
-            exit()
 
         locs = np.array(locs, dtype=float)
 
@@ -127,71 +244,40 @@ def main():
             a.node[i]['xyz'] = xyz [i]
             a.node[i]['xy' ] = xy  [i]
 
-        # EXTRA_SAMPLES attempts to get graph with few missing keys
-        # Try to minimuze TK + 2*MK where
-        #   TK is the total number of missing keys
-        #   MK is the maximum number of missing keys for any single portal
-        bestgraph = None
-        bestlack = np.inf
-        bestTK = np.inf
-        bestMK = np.inf
-
-        allTK = []
-        allMK = []
-        allWeights = []
-
-        sinceImprove = 0
-
-        while sinceImprove < EXTRA_SAMPLES:
-            b = a.copy()
-
-            sinceImprove += 1
-
-            if not maxfield.maxFields(b):
-                print 'Randomization failure\n\tThe program may work if you try again. It is more likely to work if you remove some portals.'
-                continue
-
-            TK = 0
-            MK = 0
-            for j in xrange(n):
-                keylack = max(b.in_degree(j)-b.node[j]['keys'],0)
-                TK += keylack
-                if keylack > MK:
-                    MK = keylack
-
-            weightedlack = TK+2*MK
-
-            allTK.append(TK)
-            allMK.append(MK)
-            allWeights.append(weightedlack)
-
-            if weightedlack < bestlack:
-                sinceImprove = 0
-                print 'IMPROVEMENT:\ttotal: {}\tmax: {}\tweighted: {}\t{} tries since improvement'.format(TK, MK, weightedlack, sinceImprove)
-                bestgraph = b
-                bestlack = weightedlack
-                bestTK  = TK
-                bestMK  = MK
-            else:
-                print 'this time:\ttotal: {}\tmax: {}\tweighted: {}\t{} tries since improvement'.format(TK, MK, weightedlack, sinceImprove)
-
-            if weightedlack <= 0:
-                print 'KEY PERFECTION'
-                bestlack = weightedlack
-                bestTK  = TK
-                bestMK  = MK
-                break
-            # if num agent keys is zero, this code isn't true...
-            # if all([ b.node[i]['keys'] <= b.out_degree(i) for i in xrange(n) ]):
-            #     print 'All keys used. Improvement impossible'
-            #     break
+        # Which portals are on which side of each pair. Triangles look up their contents in it
+        sides = geometry.sideSets(xyz)
+
+        if args['--seed'] is None:
+            seed = sampling.newSeed()
+        else:
+            seed = int(args['--seed'])
+
+        if args['--sample'] is not None:
+            # Rebuild a single known sample instead of searching
+            result = sampling.replay(a,seed,int(args['--sample']),sides,moves)
+            if result is None:
+                print 'Sample {} of seed {} is a randomization failure'.format(args['--sample'],seed)
+                exit()
+            TK,MK,bestgraph = result
+            allTK,allMK,allWeights = [TK],[MK],[TK+2*MK]
+        else:
+            print 'Sampling with seed {}'.format(seed)
+            # EXTRA_SAMPLES attempts to get graph with few missing keys
+            # Try to minimuze TK + 2*MK (see lib/PlanGraph.py)
+            bestgraph,allTK,allMK,allWeights = sampling.optimize(a,EXTRA_SAMPLES,seed,workers,sides,deadline,moves)
 
         if bestgraph == None:
             print 'EXITING RANDOMIZATION LOOP WITHOUT SOLUTION!'
             print ''
             exit()
 
+        bestTK,bestMK = sampling.keyLack(bestgraph)
         print 'Choosing plan requiring {} additional keys, max of {} from single portal'.format(bestTK, bestMK)
+        if bestgraph.improveMoves > 0:
+            # The time limit may have stopped the local search before all the moves
+            print 'Rebuild this plan with: --seed {} --sample {} --improve {}'.format(bestgraph.sampleSeed[0], bestgraph.sampleSeed[1], bestgraph.improveMoves)
+        else:
+            print 'Rebuild this plan with: --seed {} --sample {}'.format(*bestgraph.sampleSeed)
 
         plt.clf()
         plt.scatter(allTK,allMK,c=allWeights,marker='o')
@@ -205,14 +291,23 @@ def main():
 
         a = bestgraph # remember: a = nx.DiGraph()
 
+        # A portal exactly in line between two others inside the perimeter is in none of the triangles
+        unlinked = [ a.node[p]['name'] for p in xrange(a.order()) if a.degree(p) == 0 ]
+        if len(unlinked) > 0:
+            print u'These portals are in line with others and could not be put in the plan: {0}'.format(u', '.join(unlinked)).encode('utf-8')
+
         # Attach to each edge a list of fields that it completes
         for t in a.triangulation:
             t.markEdgesWithFields()
 
         agentOrder.improveEdgeOrder(a)
 
+        # The portal distances (n x n floats) are left out of the .pkl. portalDists makes them again
+        dists = a.dists
+        del a.dists
         with open(output_directory+output_file,'w') as fout:
             pickle.dump(a, fout)
+        a.dists = dists
     else:
         with open(input_file,'r') as fin:
             a = pickle.load(fin)
@@ -221,15 +316,53 @@ def main():
     #    with open(output_directory+output_file,'w') as fout:
     #        pickle.dump(a,fout)
 
-    PP = PlanPrinterMap.PlanPrinter(a, output_directory, nagents, COLOR)
+    # if the ith link to be made is (p,q) then orderedEdges[i] = (p,q)
+    orderedEdges = [None]*a.size()
+    for p,q in a.edges_iter():
+        orderedEdges[a.edge[p][q]['order']] = (p,q)
+
+    schedules = agentOrder.sweepAgents(a,agentCounts,orderedEdges,workers,engine)
+
+    if len(agentCounts) > 1:
+        nagents = agentOrder.chooseAgents(schedules,target)
+
+        lines = agentOrder.sweepTable(schedules)
+        if target is not None and sum(schedules[nagents][1:]) > target:
+            lines.append('No team finishes within {} minutes'.format(target/60))
+        lines.append('Using {} agents'.format(nagents))
+        with open(output_directory+'agentSweep.txt','w') as fout:
+            fout.write('\n'.join(lines)+'\n')
+        print '\n'.join(lines)
+
+    movements,a.walktime,a.commtime,a.linktime = schedules[nagents]
+
+    PP = PlanPrinterMap.PlanPrinter(a, output_directory, nagents, COLOR, movements)
     PP.keyPrep()
     PP.agentKeys()
-    PP.planMap()
+
+    if len(exportFormats) > 0:
+        export = planExport.PlanExport(a, PP.movements, COLOR)
+        for fmt in exportFormats:
+            export.write(output_directory+planExport.FILENAMES[fmt], fmt)
+
+    if args['--no-images']:
+        provider = None
+    elif args['--no-basemap']:
+        provider = False
+    else:
+        try:
+            provider = basemap.choose(args['--tiles'])
+        except basemap.MapUnavailable as e:
+            print 'Making the maps without a background: %s'%e
+            provider = False
+    if not args['--no-images']:
+        PP.planMap(provider)
     PP.agentLinks()
 
-    # These make step-by-step instructional images
-    PP.animate()
-    PP.split3instruct()
+    if not args['--no-images']:
+        # These make step-by-step instructional images
+        PP.animate(workers,animationFormat)
+        PP.split3instruct(workers,animationFormat)
 
     print "Number of portals: {0}".format(PP.num_portals)
     print "Number of links: {0}".format(PP.num_links)